@@ -0,0 +1,151 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+# arrays at least this large are stored once, as their own file, and only referenced by the stage parameters
+MIN_ARTIFACT_BYTES = 4096
+
+# suffix of the stage parameter which holds the content hash of an array stored separately
+REFERENCE_SUFFIX = '__artifact'
+
+
+def content_hash(*parts):
+
+    # parts are arrays or strings; dtype and shape are part of the content of an array
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            digest.update(str(part.dtype.str).encode() + str(part.shape).encode())
+            digest.update(part.data if part.size else b'')
+        else:
+            digest.update(str(part).encode())
+        digest.update(b'|')
+
+    return digest.hexdigest()
+
+
+class Artifact_cache:
+
+    """
+    Content-addressed store of the stage parameter files under output_dir/autogen:
+
+        -- large arrays (eg row indices, responses shipped with a stage) are stored as <hash>.npy, written only if
+           no file with that content exists yet
+        -- the small parameters (k, Cholesky factor, epsilon, lambda, ...) and the hashes of the large arrays go in
+           <stage_name>_<hash>.npz, so an unchanged stage is the same file and is neither rewritten nor re-read
+        -- once the directory holds more than max_bytes, the least recently used files are deleted, except those
+           of the stage being written
+    """
+
+    def __init__(self, directory, max_bytes=2*1024*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def filepath(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def store(self, filename, write_function):
+
+        # write if missing, otherwise only mark the file as recently used
+        filepath = self.filepath(filename)
+        if os.path.exists(filepath):
+            self.hits += 1
+            os.utime(filepath)
+        else:
+            self.misses += 1
+            # write under a temporary name so that readers never see a partial file
+            temporary_filepath = filepath + '.' + str(os.getpid()) + '.tmp'
+            with open(temporary_filepath, 'wb') as handle:
+                write_function(handle)
+            os.replace(temporary_filepath, filepath)
+
+        return filepath
+
+    def write_stage(self, stage_name, stage_params):
+
+        small_params = {}
+        used_files = set()
+        for name, value in stage_params.items():
+            array = np.asarray(value)
+            if array.nbytes >= MIN_ARTIFACT_BYTES and array.dtype != object:
+                array_hash = content_hash(array)
+                used_files.add(self.store(array_hash + '.npy', lambda handle: np.save(handle, array)))
+                small_params[name + REFERENCE_SUFFIX] = np.array(array_hash)
+            else:
+                small_params[name] = array
+
+        stage_hash = content_hash(*[part for name in sorted(small_params) for part in (name, small_params[name])])
+        stage_params_filepath = self.store(stage_name + '_' + stage_hash + '.npz',
+                                           lambda handle: np.savez(handle, **small_params))
+        used_files.add(stage_params_filepath)
+
+        self.evict(used_files)
+
+        return stage_params_filepath
+
+    def evict(self, keep_filepaths):
+
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.tmp'):
+                continue
+            filepath = self.filepath(filename)
+            try:
+                status = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            entries.append((status.st_mtime, status.st_size, filepath))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, filepath in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if filepath in keep_filepaths:
+                continue
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+
+# arrays already read by this worker, by content hash, least recently used evicted first
+loaded_artifacts = OrderedDict()
+MAX_LOADED_ARTIFACTS = 16
+
+
+def load_stage_params(stage_params_filepath):
+
+    """
+    Arguments:
+
+        stage_params_filepath: file written by Artifact_cache.write_stage
+
+    Returns:
+
+        stage_params: dictionary of the stage parameters, with the arrays stored separately read back in (each
+                      distinct array is only read once by a worker while it stays in use)
+    """
+    directory = os.path.dirname(stage_params_filepath)
+
+    stage_params = {}
+    with np.load(stage_params_filepath) as stored_params:
+        for name in stored_params.files:
+            if not name.endswith(REFERENCE_SUFFIX):
+                stage_params[name] = stored_params[name]
+                continue
+
+            array_hash = str(stored_params[name])
+            if array_hash in loaded_artifacts:
+                loaded_artifacts.move_to_end(array_hash)
+            else:
+                loaded_artifacts[array_hash] = np.load(os.path.join(directory, array_hash + '.npy'))
+                if len(loaded_artifacts) > MAX_LOADED_ARTIFACTS:
+                    loaded_artifacts.popitem(last=False)
+            stage_params[name[:-len(REFERENCE_SUFFIX)]] = loaded_artifacts[array_hash]
+
+    return stage_params
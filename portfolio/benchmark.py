@@ -0,0 +1,341 @@
+#!/usr/bin/env python3.6
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import platform
+import resource
+import argparse
+import logging
+import tempfile
+import subprocess
+import numpy as np
+import torch
+import knn
+import cvar_lp
+import scheduling
+import portfolio
+import executors
+import compute_session
+import value_at_risk
+
+ME_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def reset_peak_rss():
+
+    # Linux: writing 5 to clear_refs resets the peak resident set size (VmHWM) of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_bytes():
+
+    # peak resident set size since the last reset_peak_rss (since process start where it cannot be reset)
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def summarize(benchmark, latencies, num_ops, peak_rss, **labels):
+
+    """
+    Arguments:
+
+        benchmark: name of the benchmark
+        latencies: wall time of every timed call (seconds)
+        num_ops: queries (or samples, contexts) processed by all the calls
+        peak_rss: peak resident set size over the calls (bytes)
+        labels: what the benchmark was run on (num_samples, k, backend, solver...)
+
+    Returns:
+
+        record: one JSON-serializable result -- ops are items, latencies are per call
+    """
+    latencies = np.asarray(latencies)
+    total_seconds = float(np.sum(latencies))
+
+    record = {'benchmark': benchmark}
+    record.update(labels)
+    record.update({'calls': len(latencies),
+                   'ops': num_ops,
+                   'seconds': total_seconds,
+                   'ops_per_sec': num_ops / total_seconds if total_seconds > 0 else None,
+                   'p50_latency_ms': float(np.percentile(latencies, 50)) * 1000,
+                   'p99_latency_ms': float(np.percentile(latencies, 99)) * 1000,
+                   'peak_rss_mb': peak_rss / 2**20})
+
+    return record
+
+
+def timed_calls(function, arguments_list):
+
+    # wall time of function(*arguments) for each arguments, and the peak RSS over all of them
+    reset_peak_rss()
+    latencies = []
+    for arguments in arguments_list:
+        ts = time.perf_counter()
+        function(*arguments)
+        latencies.append(time.perf_counter() - ts)
+
+    return latencies, peak_rss_bytes()
+
+
+# runs gen_data.py (argv[1:]) and prints its peak RSS (kB) last on stderr: unlike the rusage of children, the
+# VmHWM of the process after exec does not count the memory of the benchmark it was forked from
+GEN_DATA_RUNNER = """
+import sys, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    print([line for line in open('/proc/self/status') if line.startswith('VmHWM:')][0].split()[1], file=sys.stderr)
+"""
+
+
+def benchmark_gen_data(num_samples, data_dir, repeats):
+
+    # the script as users run it (interpreter start included), writing to data_dir/data; the last run's dataset
+    # is the one the other benchmarks use
+    os.makedirs(data_dir + '/data', exist_ok=True)
+    latencies = []
+    peak_rss = 0
+    for _ in range(repeats):
+        ts = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', GEN_DATA_RUNNER, ME_DIR + '/gen_data.py', '-d', '-n',
+                                  str(num_samples)], cwd=data_dir, check=True, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, universal_newlines=True)
+        latencies.append(time.perf_counter() - ts)
+        peak_rss = max(peak_rss, int(process.stderr.split()[-1]) * 1024)
+
+    return [summarize('gen_data', latencies, repeats * num_samples, peak_rss, num_samples=num_samples)]
+
+
+def write_full_information_stage(session, x_data, k, backend, max_block_bytes, lp_solver="ecos", query_order=None,
+                                 **stage_params):
+
+    # parameters of a full information stage (see compute_full_information_oos_cost), whitened as in
+    # compute_hyperparameters; stage_params are those of the worker function timed (eg portfolios to evaluate)
+    upper_diag = torch.from_numpy(np.cov(x_data.T, bias=True) + np.identity(x_data.shape[1])/len(x_data))
+    torch.potrf(upper_diag, out=upper_diag)
+    all_indices = np.arange(len(x_data))
+    # queries in the order of the dataset unless told otherwise
+    ordering = {} if query_order is None else {'query_order': query_order}
+
+    return session.write_stage_params("benchmark_params", k=k, lower_diag=upper_diag.transpose(0, 1), epsilon=EPSILON,
+                                      __lambda=LAMBDA, neighbor_backend=backend, lp_solver=lp_solver,
+                                      max_block_bytes=max_block_bytes, x_indices=all_indices, y_indices=all_indices,
+                                      xbar_indices=all_indices, **ordering, **stage_params)
+
+
+def benchmark_neighbors(session, x_data, k, backend, num_queries, chunk_size, max_block_bytes, queries):
+
+    stage_params_filepath = write_full_information_stage(session, x_data, k, backend, max_block_bytes)
+    labels = {'num_samples': len(x_data), 'k': k, 'backend': backend}
+
+    # whitening and neighbor index, once per stage on every worker
+    portfolio.stage = None
+    latencies, peak_rss = timed_calls(portfolio.load_stage, [(stage_params_filepath,)])
+    results = [summarize('neighbor_index', latencies, len(x_data), peak_rss, **labels)]
+    stage = portfolio.load_stage(stage_params_filepath)
+
+    # single-query search, as done for each LP (see compute_optimal_portfolio)
+    latencies, peak_rss = timed_calls(knn.nearest_neighbor_indices,
+                                      [(stage['neighbors'], stage['zbar_tensor'][j], k) for j in queries])
+    results.append(summarize('nearest_neighbor_indices', latencies, len(queries), peak_rss, **labels))
+
+    # blocks of queries, as chunks of the worker functions of the simulation: the hyperparameter search scores
+    # (naive smoother, k) against the true responses, the true cost evaluates one portfolio per query
+    num_queries = min(num_queries, len(x_data))
+    chunks = [(start, min(start + chunk_size, num_queries)) for start in range(0, num_queries, chunk_size)]
+    all_indices = np.arange(len(x_data))
+    num_assets = value_at_risk.A.shape[0]
+    portfolios = np.full((len(x_data), num_assets), 1/num_assets)
+    worker_stages = [
+        ('squared_errors_sweep', portfolio.compute_squared_errors_sweep, np.array([k]),
+         {'sweep_smoothers': np.array(["Naive"]), 'sweep_bandwidths': np.array([1.0]), 'ybar_indices': all_indices}),
+        ('true_costs', portfolio.compute_true_costs, k,
+         {'portfolios': portfolios, 'value_at_risks': value_at_risk.value_at_risk_batch(x_data, portfolios, EPSILON)}),
+    ]
+    for benchmark, worker_function, stage_k, stage_params in worker_stages:
+        stage_params_filepath = write_full_information_stage(session, x_data, stage_k, backend, max_block_bytes,
+                                                             **stage_params)
+        # loaded before timing: building the neighbor index is the neighbor_index benchmark
+        portfolio.stage = None
+        portfolio.load_stage(stage_params_filepath)
+        latencies, peak_rss = timed_calls(worker_function, [(stage_params_filepath, start, stop)
+                                                            for start, stop in chunks])
+        results.append(summarize(benchmark, latencies, num_queries, peak_rss, **labels))
+
+    return results
+
+
+def benchmark_optimal_portfolio(session, x_data, k, backend, lp_solver, max_block_bytes, queries):
+
+    # LP of each query solved from scratch: no reuse of solutions, and the HiGHS model of highs_warm is rebuilt
+    # for every query (see benchmark_optimal_portfolios for warm-started solves)
+    stage_params_filepath = write_full_information_stage(session, x_data, k, backend, max_block_bytes, lp_solver)
+    portfolio.stage = None
+
+    def solve(j):
+        cvar_lp.solution_cache.solutions.clear()
+        cvar_lp.reset_warm_start()
+        portfolio.compute_optimal_portfolio(stage_params_filepath, j)
+
+    # the first solve of a neighbor count compiles the cvxpy problem; it is not timed
+    solve(int(queries[0]))
+    latencies, peak_rss = timed_calls(solve, [(int(j),) for j in queries])
+
+    return [summarize('optimal_portfolio', latencies, len(queries), peak_rss, num_samples=len(x_data), k=k, backend=backend,
+                      solver=lp_solver)]
+
+
+def benchmark_optimal_portfolios(session, x_data, k, backend, lp_solver, max_block_bytes, num_queries, chunk_size):
+
+    # chunks of consecutive queries in locality order, as compute_full_information_oos_cost submits them, so that
+    # solvers which carry state from query to query (highs_warm) are timed as they run; no reuse of solutions
+    upper_diag = torch.from_numpy(np.cov(x_data.T, bias=True) + np.identity(x_data.shape[1])/len(x_data))
+    torch.potrf(upper_diag, out=upper_diag)
+    query_order = scheduling.morton_order(knn.whiten(torch.from_numpy(x_data), upper_diag.transpose(0, 1)).numpy())
+    stage_params_filepath = write_full_information_stage(session, x_data, k, backend, max_block_bytes, lp_solver,
+                                                         query_order)
+    portfolio.stage = None
+
+    def solve_chunk(start, stop):
+        cvar_lp.solution_cache.solutions.clear()
+        portfolio.compute_optimal_portfolios(stage_params_filepath, start, stop)
+
+    # the first solve of a neighbor count compiles the cvxpy problem; it is not timed
+    solve_chunk(0, 1)
+    num_queries = min(num_queries, len(x_data))
+    latencies, peak_rss = timed_calls(solve_chunk, [(start, min(start + chunk_size, num_queries))
+                                                    for start in range(0, num_queries, chunk_size)])
+
+    return [summarize('optimal_portfolios_locality_order', latencies, num_queries, peak_rss, num_samples=len(x_data),
+                      k=k, backend=backend, solver=lp_solver, chunk_size=chunk_size)]
+
+
+def benchmark_hyperparameters(nn_portfolio, x_data, y_data, backend, repeats):
+
+    # the whole search: every k of the grid, over an 80/20 split of the dataset
+    random.seed(0)
+    nn_portfolio.neighbor_backend = backend
+    latencies, peak_rss = timed_calls(nn_portfolio.compute_hyperparameters,
+                                      [(y_data, x_data, 0.2, None, np.arange(len(x_data)))] * repeats)
+
+    return [summarize('hyperparameters', latencies, repeats * len(x_data), peak_rss, num_samples=len(x_data), backend=backend)]
+
+
+def benchmark_value_at_risk(x_data, num_queries, repeats):
+
+    portfolios = np.full((len(x_data), value_at_risk.A.shape[0]), 1/value_at_risk.A.shape[0])
+
+    # every context at once, and one context at a time (as called from Julia)
+    latencies, peak_rss = timed_calls(value_at_risk.value_at_risk_batch, [(x_data, portfolios, EPSILON)] * repeats)
+    results = [summarize('value_at_risk_batch', latencies, repeats * len(x_data), peak_rss, num_samples=len(x_data))]
+    num_queries = min(num_queries, len(x_data))
+    latencies, peak_rss = timed_calls(value_at_risk.value_at_risk,
+                                      [(x_data[j], portfolios[j], EPSILON) for j in range(num_queries)])
+    results.append(summarize('value_at_risk', latencies, num_queries, peak_rss, num_samples=len(x_data)))
+
+    return results
+
+
+EPSILON = 0.15
+LAMBDA = 0.0
+
+parser = argparse.ArgumentParser(description="benchmark the simulation hot paths on this machine, results as JSON")
+parser.add_argument('-n', '--num_samples', type=int, nargs='+', default=[1000, 10000, 100000], help='dataset sizes, each generated with gen_data.py')
+parser.add_argument('-k', '--k_list', type=int, nargs='+', default=[10, 50, 250], help='numbers of nearest neighbors')
+parser.add_argument('--neighbor_backends', nargs='+', default=["brute", "kd_tree"], choices=["brute", "kd_tree"], help='nearest neighbor backends to compare')
+parser.add_argument('--lp_solvers', nargs='+', default=["ecos", "highs"], choices=["ecos", "highs", "highs_warm"], help='LP solvers to compare')
+parser.add_argument('-q', '--num_queries', type=int, default=200, help='queries timed per nearest neighbor benchmark')
+parser.add_argument('--num_lp_queries', type=int, default=50, help='LPs timed per solver and k')
+parser.add_argument('-c', '--chunk_size', type=int, default=32, help='queries per call of the worker function benchmarks (sweep, true costs, LP chunks)')
+parser.add_argument('-r', '--repeats', type=int, default=3, help='runs of the whole-dataset benchmarks (gen_data, hyperparameters, batched VaR)')
+parser.add_argument('-b', '--max_block_mb', type=int, default=64, help='memory budget (MB) of one block of queries of a nearest neighbor pass')
+parser.add_argument('--skip', nargs='+', default=[], choices=["gen_data", "neighbors", "optimal_portfolio", "hyperparameters", "value_at_risk"], help='benchmarks not to run')
+parser.add_argument('-o', '--output', type=str, help='JSON file to write the results to (default: stdout)')
+args = parser.parse_args()
+
+# as on the workers (see executors.setup_pool_worker)
+torch.set_num_threads(1)
+max_block_bytes = args.max_block_mb * 1024 * 1024
+
+results = []
+with tempfile.TemporaryDirectory() as work_dir:
+    os.makedirs(work_dir + '/autogen')
+
+    for num_samples in args.num_samples:
+
+        # the dataset is always generated (timed or not): every benchmark runs on data generated by this run
+        gen_data_results = benchmark_gen_data(num_samples, work_dir, 1 if "gen_data" in args.skip else args.repeats)
+        if "gen_data" not in args.skip:
+            results += gen_data_results
+
+        x_samples_filepath = work_dir + '/data/X_nt.npy'
+        y_samples_filepath = work_dir + '/data/Y_nt.npy'
+        session = compute_session.Compute_session("benchmark_session", executors.build_executor("serial"), work_dir,
+                                                  x_samples_filepath, y_samples_filepath)
+        session.start()
+        session.logger.setLevel(logging.WARNING)
+        x_data = np.load(x_samples_filepath)
+        y_data = np.load(y_samples_filepath)
+
+        queries = np.random.RandomState(0).choice(num_samples, min(args.num_queries, num_samples), replace=False)
+        lp_queries = queries[:args.num_lp_queries]
+        k_list = [k for k in args.k_list if k < num_samples]
+
+        for k in k_list:
+            if "neighbors" not in args.skip:
+                for backend in args.neighbor_backends:
+                    results += benchmark_neighbors(session, x_data, k, backend, args.num_queries, args.chunk_size,
+                                                   max_block_bytes, queries)
+
+            # solvers compared on the neighbors of the first backend
+            if "optimal_portfolio" not in args.skip:
+                for lp_solver in args.lp_solvers:
+                    results += benchmark_optimal_portfolio(session, x_data, k, args.neighbor_backends[0], lp_solver,
+                                                           max_block_bytes, lp_queries)
+                    results += benchmark_optimal_portfolios(session, x_data, k, args.neighbor_backends[0], lp_solver,
+                                                            max_block_bytes, args.num_lp_queries, args.chunk_size)
+
+        if "hyperparameters" not in args.skip:
+            nn_portfolio = portfolio.Nearest_neighbors_portfolio("benchmark_portfolio", None, None, EPSILON, LAMBDA,
+                                                                 work_dir, x_samples_filepath, y_samples_filepath,
+                                                                 session=session, max_block_bytes=max_block_bytes)
+            nn_portfolio.logger.setLevel(logging.WARNING)
+            for backend in args.neighbor_backends:
+                results += benchmark_hyperparameters(nn_portfolio, x_data, y_data, backend, args.repeats)
+
+        if "value_at_risk" not in args.skip:
+            results += benchmark_value_at_risk(x_data, args.num_queries, args.repeats)
+
+        session.close()
+
+report = {
+    'environment': {'hostname': socket.gethostname(), 'platform': platform.platform(),
+                    'python': platform.python_version(), 'numpy': np.__version__, 'torch': torch.__version__,
+                    'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads(), 'time': time.ctime()},
+    'config': vars(args),
+    'results': results,
+}
+
+if args.output:
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
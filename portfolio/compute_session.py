@@ -0,0 +1,255 @@
+import os
+import time
+import numpy as np
+import logging
+import tracing
+from decorators import timed
+import scheduling
+import artifact_cache
+import telemetry
+
+
+class Compute_session:
+
+    """
+    Workers are started and the dataset is loaded on each worker (or node) once per simulation. Each stage then
+    only writes a small parameters file (k, Cholesky factor, epsilon, lambda, row indices) and submits jobs which
+    reference it (see portfolio.load_stage). Large arrays of a stage are stored once under output_dir/autogen by
+    content hash (see artifact_cache.py). Where the jobs run is up to the executor (see executors.py).
+
+    If checkpoint_dir is set, the result of every chunk is saved there as soon as it comes back, with the hash of
+    what it was computed from (worker function, stage parameters, dataset). If resume is also set, chunks already
+    saved for the same stage by an interrupted run are loaded instead of being recomputed.
+    """
+
+    def __init__(self, name, executor, output_dir, x_samples_filepath, y_samples_filepath, chunk_target_seconds=2.0, autogen_max_bytes=2*1024*1024*1024, checkpoint_dir=None, resume=False):
+        self.name = name
+        self.executor = executor
+        self.output_dir = output_dir
+        self.x_samples_filepath = x_samples_filepath
+        self.y_samples_filepath = y_samples_filepath
+        # stage parameters and their large arrays, content-addressed, at most autogen_max_bytes on disk
+        self.artifact_cache = artifact_cache.Artifact_cache(output_dir + '/autogen', autogen_max_bytes)
+        # per-chunk results of every stage, to resume from
+        self.checkpoint_dir = checkpoint_dir
+        # load the chunks checkpointed by an earlier run (otherwise they are only written)
+        self.resume = resume
+        # per-node and per-phase summary of the telemetry of every job, written to output_dir/dispy on close
+        self.telemetry_report = telemetry.Telemetry_report()
+        # wall time aimed for by each chunk of queries once runtimes are known
+        self.chunk_target_seconds = chunk_target_seconds
+        self.configure_logger()
+
+    def __str__(self):
+        return self.name
+
+    def configure_logger(self):
+        # create logger
+        self.logger = logging.getLogger(self.name)
+        self.logger.propagate = 0
+        # set "verbosity"
+        self.logger.setLevel(logging.INFO)
+        # create console handler
+        self.ch = logging.StreamHandler()
+        self.ch.setLevel(logging.INFO)
+        # create formatter and add it to the handlers
+        # lines are indented by the nesting of the current span (see tracing.Indent_filter)
+        formatter = logging.Formatter('%(indent)s%(name)s - %(levelname)s: - %(message)s')
+        self.ch.setFormatter(formatter)
+        self.ch.addFilter(tracing.indent_filter)
+        # add the handlers to the logger
+        self.logger.addHandler(self.ch)
+
+    @timed
+    def start(self):
+
+        self.executor.start(self.x_samples_filepath, self.y_samples_filepath, self.output_dir)
+
+    def write_stage_params(self, stage_name, **stage_params):
+
+        # the file is named by the content hash of the parameters, so workers never confuse two stages and an
+        # unchanged stage is neither rewritten nor re-read
+        return self.artifact_cache.write_stage(stage_name, stage_params)
+
+    def run_chunks(self, function_name, stage_params_filepath, num_items, consume):
+
+        """
+        Arguments:
+
+            function_name: name of the worker function in portfolio.py, called as
+                           function_name(stage_params_filepath, start, stop)
+            stage_params_filepath: file returned by write_stage_params
+            num_items: number of queries of the stage
+            consume: called as consume(start, stop, result) on the result of every chunk, in the order chunks
+                     complete (eg to write it into a preallocated array and update running aggregates)
+
+        Description:
+
+            Queries are submitted as index ranges whose sizes are tuned from the runtimes of the chunks completed
+            so far (see scheduling.Guided_chunker). A window of two chunks per worker is kept in flight so workers
+            never wait on the driver, and whichever chunk completes first is consumed first, so a slow chunk does
+            not hold up the others. Results are not kept once consumed: the memory of the driver does not grow
+            with num_items. When resuming, chunks found in the checkpoint of the stage are consumed from there
+            instead of being submitted again.
+        """
+        stage_checkpoint_dir = self.stage_checkpoint_dir(function_name, stage_params_filepath)
+        stage_hash = self.stage_hash(function_name, stage_params_filepath) if stage_checkpoint_dir else None
+        checkpointed_chunks = self.checkpointed_chunks(stage_checkpoint_dir) if self.resume else {}
+
+        # ranges of queries not completed yet
+        missing_ranges = []
+        next_start = 0
+        for start, stop in sorted(checkpointed_chunks) + [(num_items, num_items)]:
+            if start > next_start:
+                missing_ranges.append((next_start, start))
+            next_start = max(next_start, stop)
+        if checkpointed_chunks:
+            self.logger.info(function_name + ": " + str(num_items - sum(stop - start for start, stop in missing_ranges)) +
+                             " of " + str(num_items) + " queries resumed from " + stage_checkpoint_dir)
+        for (start, stop), chunk_filepath in sorted(checkpointed_chunks.items()):
+            consume(start, stop, self.load_chunk(chunk_filepath, stage_hash))
+
+        chunker = scheduling.Guided_chunker(num_items, self.executor.num_workers, self.chunk_target_seconds,
+                                            ranges=missing_ranges)
+        window = 2 * self.executor.num_workers
+
+        # chunk and submission time of each job in flight, by job
+        in_flight = {}
+        with tracing.tracer.span("run_chunks", function_name=function_name, num_items=num_items):
+            while True:
+
+                # top up the window
+                while len(in_flight) < window:
+                    chunk = chunker.next_chunk()
+                    if chunk is None:
+                        break
+                    in_flight[self.executor.submit(function_name, stage_params_filepath, chunk)] = (chunk, time.time())
+
+                if not in_flight:
+                    break
+
+                job = self.executor.wait_any()
+                (start, stop), submit_time = in_flight.pop(job)
+                result, job_telemetry = self.executor.collect(job)
+                self.telemetry_report.record(function_name, start, stop, job_telemetry, time.time() - submit_time)
+                chunker.record(start, stop, job_telemetry['end'] - job_telemetry['start'])
+                self.save_checkpoint(stage_checkpoint_dir, start, stop, result, stage_hash)
+                consume(start, stop, result)
+
+    def stage_checkpoint_dir(self, function_name, stage_params_filepath):
+
+        if self.checkpoint_dir is None:
+            return None
+
+        # stage parameters files are named by the content hash of the parameters, so a stage with the same
+        # parameters on the same dataset has the same checkpoint
+        stage_name = os.path.splitext(os.path.basename(stage_params_filepath))[0]
+
+        return os.path.join(self.checkpoint_dir, function_name + '_' + stage_name + '_' + self.dataset_hash()[:8])
+
+    def dataset_hash(self):
+        return artifact_cache.content_hash(*[part for filepath in [self.x_samples_filepath, self.y_samples_filepath]
+                                             for part in (os.path.realpath(filepath), os.stat(filepath).st_size,
+                                                          os.stat(filepath).st_mtime_ns)])
+
+    def stage_hash(self, function_name, stage_params_filepath):
+
+        # what the chunks of a stage are computed from: worker function, every stage parameter (separately stored
+        # arrays included, by value) and dataset -- independent of how and when the parameters file was written
+        stage_params = artifact_cache.load_stage_params(stage_params_filepath)
+        return artifact_cache.content_hash(function_name, self.dataset_hash(),
+                                           *[part for name in sorted(stage_params)
+                                             for part in (name, np.asarray(stage_params[name]))])
+
+    @staticmethod
+    def checkpointed_chunks(stage_checkpoint_dir):
+
+        # file of every chunk saved so far, by (start, stop)
+        chunks = {}
+        if stage_checkpoint_dir is None or not os.path.isdir(stage_checkpoint_dir):
+            return chunks
+
+        for filename in os.listdir(stage_checkpoint_dir):
+            if filename.endswith('.npz'):
+                start, stop = [int(bound) for bound in filename[:-len('.npz')].split('_')]
+                chunks[(start, stop)] = os.path.join(stage_checkpoint_dir, filename)
+
+        return chunks
+
+    @staticmethod
+    def load_chunk(chunk_filepath, stage_hash):
+
+        # a single array, or the arrays of a tuple in order (see save_checkpoint)
+        with np.load(chunk_filepath) as chunk:
+            if 'stage_hash' not in chunk.files or str(chunk['stage_hash']) != stage_hash:
+                raise ValueError("ERROR: checkpoint " + chunk_filepath + " was not computed from the stage being "
+                                 "resumed (different parameters or dataset): resume from the output directory of "
+                                 "the same run, or start afresh")
+            if 'result' in chunk.files:
+                return chunk['result']
+            return tuple(chunk['arr_' + str(i)] for i in range(len(chunk.files) - 1))
+
+    @staticmethod
+    def save_checkpoint(stage_checkpoint_dir, start, stop, result, stage_hash):
+
+        if stage_checkpoint_dir is None:
+            return
+
+        os.makedirs(stage_checkpoint_dir, exist_ok=True)
+
+        # written under a temporary name so that a run interrupted mid-write leaves no partial chunk behind
+        filepath = os.path.join(stage_checkpoint_dir, str(start) + '_' + str(stop) + '.npz')
+        with open(filepath + '.tmp', 'wb') as handle:
+            if isinstance(result, tuple):
+                np.savez(handle, *result, stage_hash=stage_hash)
+            else:
+                np.savez(handle, result=result, stage_hash=stage_hash)
+        os.replace(filepath + '.tmp', filepath)
+
+    def close(self):
+
+        self.executor.close()
+
+        # next to the dispy logs
+        if self.telemetry_report.functions:
+            os.makedirs(self.output_dir + '/dispy', exist_ok=True)
+            telemetry_filepath = self.output_dir + '/dispy/telemetry.json'
+            self.telemetry_report.write(telemetry_filepath)
+            self.logger.info("Job telemetry (per node and per phase) written to " + telemetry_filepath)
+
+
+class Running_moments:
+
+    """
+    Count, mean and variance of a stream of values, updated one batch at a time as results arrive (batches are
+    merged as in Chan et al's parallel algorithm, so the order they arrive in does not matter)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_squared_deviations = 0.0
+
+    def update(self, values):
+
+        values = np.asarray(values, dtype=np.float64).reshape(-1)
+        if len(values) == 0:
+            return
+
+        batch_count = len(values)
+        batch_mean = values.mean()
+        batch_sum_squared_deviations = np.sum(np.square(values - batch_mean))
+
+        count = self.count + batch_count
+        delta = batch_mean - self.mean
+        self.mean += delta * batch_count / count
+        self.sum_squared_deviations += batch_sum_squared_deviations + delta**2 * self.count * batch_count / count
+        self.count = count
+
+    def variance(self):
+
+        # population variance, like np.var
+        return self.sum_squared_deviations / self.count if self.count else float('nan')
+
+    def __str__(self):
+        return "mean " + str(self.mean) + ", std " + str(np.sqrt(self.variance())) + " (" + str(self.count) + " samples)"
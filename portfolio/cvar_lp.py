@@ -0,0 +1,394 @@
+from collections import OrderedDict
+import hashlib
+import numpy as np
+import cvxpy as cp
+from scipy import sparse
+from scipy.optimize import linprog
+import telemetry
+
+# highspy is only needed by the highs_warm solver
+try:
+    import highspy
+except ImportError:
+    highspy = None
+
+
+class Cvar_problem:
+
+    """
+    CVaR portfolio LP over num_neighbors scenarios, built and canonicalized once:
+
+        minimize    sum(L)/num_neighbors
+        subject to  z >= 0, sum(z) == 1
+                    L >= (1-1/epsilon)*b - (lambda+1/epsilon)*R z
+                    L >= b - lambda*R z
+
+    R (neighbor returns, one scenario per row), epsilon and lambda are parameters. Products of parameters are not
+    DPP, so R is held pre-scaled by (lambda+1/epsilon) and by lambda.
+    """
+
+    def __init__(self, num_neighbors, num_assets):
+        self.num_neighbors = num_neighbors
+        self.num_assets = num_assets
+
+        self.z = cp.Variable(num_assets)
+        self.L = cp.Variable(num_neighbors)
+        self.b = cp.Variable(1)
+
+        self.var_scale = cp.Parameter()
+        self.cvar_returns = cp.Parameter((num_neighbors, num_assets))
+        self.mean_returns = cp.Parameter((num_neighbors, num_assets))
+
+        obj = cp.Minimize(cp.sum(self.L)/num_neighbors)
+
+        # Constraints
+        # long only and unit leverage, then the two pieces of the loss function in matrix form
+        constrs = [self.z >= 0, cp.sum(self.z) == 1,
+                   self.L >= self.var_scale*self.b - self.cvar_returns @ self.z,
+                   self.L >= self.b - self.mean_returns @ self.z]
+
+        self.problem = cp.Problem(obj, constrs)
+
+    def solve(self, nearest_neighbors, epsilon, lambda_, solver=cp.ECOS):
+
+        # only parameter values change between queries; cvxpy reuses the canonicalization (ECOS itself has no
+        # warm start, see Warm_cvar_problem for one that does)
+        self.var_scale.value = 1-1/epsilon
+        self.cvar_returns.value = (lambda_+1/epsilon)*nearest_neighbors
+        self.mean_returns.value = lambda_*nearest_neighbors
+
+        # time in the solver itself (as reported by it) is split from cvxpy's own share of the solve call
+        with telemetry.job.phase("lp_build"):
+            self.problem.solve(solver=solver)
+            solver_stats = self.problem.solver_stats
+            if solver_stats is not None and solver_stats.solve_time is not None:
+                telemetry.job.add_phase("lp_solver", solver_stats.solve_time)
+            if solver_stats is not None and solver_stats.num_iters is not None:
+                telemetry.job.count("solver_iterations", solver_stats.num_iters)
+
+        return (self.problem.value, self.z.value, self.b.value, self.problem.status)
+
+
+class Cvar_problem_cache:
+
+    """
+    Compiled problems of a worker, keyed by (neighbor count, asset count), least recently used evicted first
+    """
+
+    def __init__(self, max_size=32):
+        self.max_size = max_size
+        self.problems = OrderedDict()
+
+    def get(self, num_neighbors, num_assets):
+
+        key = (num_neighbors, num_assets)
+        if key in self.problems:
+            self.problems.move_to_end(key)
+        else:
+            with telemetry.job.phase("lp_compile"):
+                self.problems[key] = Cvar_problem(num_neighbors, num_assets)
+            if len(self.problems) > self.max_size:
+                self.problems.popitem(last=False)
+
+        return self.problems[key]
+
+
+class Solution_cache:
+
+    """
+    Optimal portfolios of a worker, keyed by the set of neighbor rows and the problem parameters: the LP only
+    depends on which scenarios are in it, not on their order, so queries with the same inclusive neighbor set
+    share one solve. Least recently used entries are evicted first.
+
+    If shared is set (a dict-like visible to every worker, eg a multiprocessing Manager dict), local misses are
+    looked up there and new solutions are published there, until it holds max_size entries.
+    """
+
+    def __init__(self, max_size=65536, shared=None):
+        self.max_size = max_size
+        self.shared = shared
+        self.solutions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def fingerprint(neighbor_rows, epsilon, lambda_, *extra):
+
+        # sorted so that the key is that of the set; hashed so that keys stay small whatever k is
+        neighbor_rows = np.sort(np.asarray(neighbor_rows, dtype=np.int64))
+        digest = hashlib.blake2b(neighbor_rows.tobytes(), digest_size=16).hexdigest()
+
+        return (digest, float(epsilon), float(lambda_)) + tuple(extra)
+
+    def get(self, key):
+
+        solution = self.solutions.get(key)
+        if solution is not None:
+            self.solutions.move_to_end(key)
+        elif self.shared is not None:
+            solution = self.shared.get(key)
+            if solution is not None:
+                self.put(key, solution, publish=False)
+
+        if solution is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return solution
+
+    def put(self, key, solution, publish=True):
+
+        self.solutions[key] = solution
+        if len(self.solutions) > self.max_size:
+            self.solutions.popitem(last=False)
+
+        if publish and self.shared is not None and len(self.shared) < self.max_size:
+            self.shared[key] = solution
+
+
+# one cache of each per worker process
+problem_cache = Cvar_problem_cache()
+solution_cache = Solution_cache()
+
+
+def solve_cvxpy(nearest_neighbors, epsilon, lambda_, scenario_ids=None):
+
+    """
+    Arguments:
+
+        nearest_neighbors: returns of the nearest neighbors, one scenario per row
+        epsilon: CVaR level
+        lambda_: weight of the mean return in the loss
+        scenario_ids: identity of each scenario (see solve_highs_warm), not needed here
+
+    Returns:
+
+        (optimal value, optimal portfolio z, value at risk b, solver status)
+    """
+    nearest_neighbors = np.asarray(nearest_neighbors)
+    problem = problem_cache.get(*nearest_neighbors.shape)
+
+    return problem.solve(nearest_neighbors, float(epsilon), float(lambda_))
+
+
+# scipy.optimize.linprog status codes, translated to cvxpy's status strings
+HIGHS_STATUS = {
+    0: cp.OPTIMAL,
+    1: cp.USER_LIMIT,
+    2: cp.INFEASIBLE,
+    3: cp.UNBOUNDED,
+}
+
+
+def solve_highs(nearest_neighbors, epsilon, lambda_, scenario_ids=None):
+
+    """
+    Same problem and return value as solve_cvxpy, but the constraint matrix is assembled directly and handed to
+    HiGHS, with no modeling layer in between. Variables are stacked as x = [z, b, L]:
+
+        minimize    sum(L)/num_neighbors
+        subject to  -(lambda+1/epsilon)*R z + (1-1/epsilon)*b - L <= 0
+                    -lambda*R z + b - L <= 0
+                    sum(z) == 1, z >= 0, b and L free
+
+    Every LP is solved from scratch (linprog's HiGHS interface takes no starting point).
+    """
+    nearest_neighbors = np.asarray(nearest_neighbors)
+    num_neighbors, num_assets = nearest_neighbors.shape
+
+    with telemetry.job.phase("lp_build"):
+        c = np.concatenate([np.zeros(num_assets + 1), np.full(num_neighbors, 1/num_neighbors)])
+
+        identity = sparse.identity(num_neighbors, format='csr')
+        A_ub = sparse.bmat([[sparse.csr_matrix(-(lambda_+1/epsilon)*nearest_neighbors),
+                             sparse.csr_matrix(np.full((num_neighbors, 1), 1-1/epsilon)), -identity],
+                            [sparse.csr_matrix(-lambda_*nearest_neighbors),
+                             sparse.csr_matrix(np.ones((num_neighbors, 1))), -identity]], format='csr')
+        b_ub = np.zeros(2 * num_neighbors)
+
+        A_eq = sparse.csr_matrix(np.concatenate([np.ones(num_assets), np.zeros(num_neighbors + 1)]).reshape(1, -1))
+        b_eq = np.ones(1)
+
+        bounds = [(0, None)] * num_assets + [(None, None)] * (num_neighbors + 1)
+
+    with telemetry.job.phase("lp_solver"):
+        result = linprog(c, A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq, bounds=bounds, method='highs')
+    if getattr(result, 'nit', None) is not None:
+        telemetry.job.count("solver_iterations", int(result.nit))
+
+    status = HIGHS_STATUS.get(result.status, cp.SOLVER_ERROR)
+    if result.x is None:
+        return (None, None, None, status)
+
+    # b is returned as a 1-element array, like cvxpy's Variable(1)
+    return (result.fun, result.x[:num_assets], result.x[num_assets:num_assets + 1], status)
+
+
+class Warm_cvar_problem:
+
+    """
+    The LP of solve_highs, kept in one HiGHS model from query to query. Each scenario (neighbor) owns one L column
+    and two rows: between two queries, the scenarios which left the neighbor set are deleted from the model and the
+    new ones are added, and HiGHS restarts the simplex from the optimal basis of the previous query, which stays
+    valid for every scenario kept. Queries in locality order (see scheduling.morton_order) share most of their
+    neighbors, so each one only takes a few simplex iterations.
+
+    Scenarios are matched by scenario_ids (eg their rows in the dataset), which must keep referring to the same
+    responses for as long as the problem is used.
+    """
+
+    def __init__(self, num_assets, epsilon, lambda_):
+
+        if highspy is None:
+            raise ImportError("the highs_warm LP solver needs highspy")
+
+        self.num_assets = num_assets
+        self.epsilon = epsilon
+        self.lambda_ = lambda_
+
+        self.highs = highspy.Highs()
+        self.highs.setOptionValue('output_flag', False)
+
+        # columns z, b, then one L column per scenario; row 0 is sum(z) == 1, then two rows per scenario
+        no_entries = np.array([], dtype=np.int32)
+        self.highs.addCols(num_assets + 1, np.zeros(num_assets + 1),
+                           np.concatenate([np.zeros(num_assets), [-highspy.kHighsInf]]),
+                           np.full(num_assets + 1, highspy.kHighsInf), 0, no_entries, no_entries, np.array([]))
+        self.highs.addRows(1, np.ones(1), np.ones(1), num_assets, np.zeros(1, dtype=np.int32),
+                           np.arange(num_assets, dtype=np.int32), np.ones(num_assets))
+
+        # scenario id of each L column, in model order
+        self.scenarios = []
+
+    def update(self, nearest_neighbors, scenario_ids):
+
+        num_assets = self.num_assets
+        scenario_ids = [int(scenario) for scenario in scenario_ids]
+
+        # scenarios which left: their L column and their two rows
+        wanted = set(scenario_ids)
+        leaving = np.array([position for position, scenario in enumerate(self.scenarios) if scenario not in wanted],
+                           dtype=np.int32)
+        if len(leaving):
+            rows = np.stack([1 + 2*leaving, 2 + 2*leaving], 1).reshape(-1).astype(np.int32)
+            self.highs.deleteRows(len(rows), rows)
+            self.highs.deleteCols(len(leaving), (num_assets + 1 + leaving).astype(np.int32))
+            self.scenarios = [scenario for scenario in self.scenarios if scenario in wanted]
+
+        # new scenarios, rows as in solve_highs:
+        #   -(lambda+1/epsilon)*r z + (1-1/epsilon)*b - L <= 0
+        #   -lambda*r z + b - L <= 0
+        kept = set(self.scenarios)
+        entering = [position for position, scenario in enumerate(scenario_ids) if scenario not in kept]
+        if entering:
+            num_entering = len(entering)
+            first_column = num_assets + 1 + len(self.scenarios)
+            no_entries = np.array([], dtype=np.int32)
+            self.highs.addCols(num_entering, np.zeros(num_entering), np.full(num_entering, -highspy.kHighsInf),
+                               np.full(num_entering, highspy.kHighsInf), 0, no_entries, no_entries, np.array([]))
+
+            returns = np.asarray(nearest_neighbors)[entering]
+            values = np.empty((num_entering, 2, num_assets + 2))
+            values[:, 0, :num_assets] = -(self.lambda_ + 1/self.epsilon)*returns
+            values[:, 1, :num_assets] = -self.lambda_*returns
+            values[:, :, num_assets] = [1 - 1/self.epsilon, 1]
+            values[:, :, num_assets + 1] = -1
+            indices = np.empty((num_entering, 2, num_assets + 2), dtype=np.int32)
+            indices[:, :, :num_assets + 1] = np.arange(num_assets + 1)
+            indices[:, :, num_assets + 1] = (first_column + np.arange(num_entering))[:, None]
+            self.highs.addRows(2*num_entering, np.full(2*num_entering, -highspy.kHighsInf), np.zeros(2*num_entering),
+                               values.size, (np.arange(2*num_entering)*(num_assets + 2)).astype(np.int32),
+                               indices.reshape(-1), values.reshape(-1))
+            self.scenarios += [scenario_ids[position] for position in entering]
+
+        # the objective is the mean of L over however many scenarios there are now
+        num_scenarios = len(self.scenarios)
+        self.highs.changeColsCost(num_scenarios, np.arange(num_assets + 1, num_assets + 1 + num_scenarios, dtype=np.int32),
+                                  np.full(num_scenarios, 1/num_scenarios))
+
+    def status(self):
+
+        # HiGHS model status, translated to cvxpy's status strings
+        model_status = self.highs.getModelStatus()
+        if model_status == highspy.HighsModelStatus.kOptimal:
+            return cp.OPTIMAL
+        if model_status == highspy.HighsModelStatus.kInfeasible:
+            return cp.INFEASIBLE
+        if model_status == highspy.HighsModelStatus.kUnbounded:
+            return cp.UNBOUNDED
+        if model_status in (highspy.HighsModelStatus.kTimeLimit, highspy.HighsModelStatus.kIterationLimit):
+            return cp.USER_LIMIT
+        return cp.SOLVER_ERROR
+
+    def solve(self, nearest_neighbors, scenario_ids):
+
+        with telemetry.job.phase("lp_build"):
+            self.update(nearest_neighbors, scenario_ids)
+
+        with telemetry.job.phase("lp_solver"):
+            self.highs.run()
+            # a warm start gone wrong numerically is retried from scratch
+            if self.status() != cp.OPTIMAL:
+                self.highs.clearSolver()
+                self.highs.run()
+        telemetry.job.count("solver_iterations", self.highs.getInfo().simplex_iteration_count)
+
+        status = self.status()
+        if status != cp.OPTIMAL:
+            return (None, None, None, status)
+
+        # scenarios are in model order, which only matters to L: z and b are returned as by solve_highs
+        x = np.asarray(self.highs.getSolution().col_value)
+        return (self.highs.getInfo().objective_function_value, x[:self.num_assets],
+                x[self.num_assets:self.num_assets + 1], status)
+
+
+# problem kept from query to query by solve_highs_warm, on each worker process
+warm_problem = None
+
+
+def reset_warm_start():
+
+    # the next query of solve_highs_warm starts from an empty model, eg when scenario ids change meaning
+    global warm_problem
+    warm_problem = None
+
+
+def solve_highs_warm(nearest_neighbors, epsilon, lambda_, scenario_ids=None):
+
+    """
+    Same problem and return value as solve_highs, solved in the model left by the previous query of this worker
+    (see Warm_cvar_problem). Without scenario_ids, the scenarios can not be matched to those already in the
+    model, and the model is started afresh.
+    """
+    global warm_problem
+
+    nearest_neighbors = np.asarray(nearest_neighbors)
+    num_assets = nearest_neighbors.shape[1]
+    if scenario_ids is None or warm_problem is None or \
+       (warm_problem.num_assets, warm_problem.epsilon, warm_problem.lambda_) != (num_assets, float(epsilon), float(lambda_)):
+        with telemetry.job.phase("lp_compile"):
+            warm_problem = Warm_cvar_problem(num_assets, float(epsilon), float(lambda_))
+
+    if scenario_ids is None:
+        scenario_ids = range(len(nearest_neighbors))
+
+    return warm_problem.solve(nearest_neighbors, scenario_ids)
+
+
+def solve(nearest_neighbors, epsilon, lambda_, lp_solver="ecos", scenario_ids=None):
+
+    switcher = {
+        "ecos": solve_cvxpy,
+        "highs": solve_highs,
+        "highs_warm": solve_highs_warm,
+    }
+
+    try:
+        solver_function = switcher[lp_solver]
+    except KeyError:
+        print('There is no LP solver called ', lp_solver)
+        raise
+
+    return solver_function(nearest_neighbors, epsilon, lambda_, scenario_ids)
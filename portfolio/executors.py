@@ -0,0 +1,272 @@
+import os
+import functools
+import queue
+from collections import deque
+import numpy as np
+import torch
+from multiprocessing import Pool as ThreadPool
+from multiprocessing import shared_memory
+from multiprocessing import Manager
+from available_cpu_count import available_cpu_count
+import portfolio
+import cvar_lp
+import tracing
+import telemetry
+
+# dispy is only needed by the dispy executor
+try:
+    import dispy
+except ImportError:
+    dispy = None
+
+ME_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def setup_session(me_dir, x_samples_filepath, y_samples_filepath, mmap=False):
+
+    # executed once per dispy node when the session starts: the dataset is loaded here and stays resident
+    global portfolio, tracing, telemetry
+    import sys
+    sys.path.insert(0, me_dir)
+    import portfolio
+    import tracing
+    import telemetry
+
+    return portfolio.load_session_data(x_samples_filepath, y_samples_filepath, mmap)
+
+
+def run_stage(function_name, stage_params_filepath, *args):
+
+    # every job of every stage goes through here; only the (small) stage parameters file and the
+    # function arguments (eg query index ranges) are shipped per job
+    telemetry.job.reset()
+    with tracing.tracer.span(function_name, args=args):
+        result = getattr(portfolio, function_name)(stage_params_filepath, *args)
+
+    # worker, runtime and phase timings of the job (see telemetry.py): the runtime drives the chunk sizes (see
+    # scheduling.py), the rest goes into the telemetry report of the session
+    return result, telemetry.job.summary()
+
+
+def attach_shared_array(name, shape, dtype):
+
+    # the driver owns (and eventually unlinks) the block, workers only map it; pool processes share the
+    # driver's resource tracker so attaching does not register the block a second time
+    shm = shared_memory.SharedMemory(name=name)
+
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def setup_pool_worker(x_shared, y_shared, shared_lp_solutions=None):
+
+    # executed once per pool process: X/Y are zero-copy views of the driver's shared memory, or, if x_shared
+    # and y_shared are file paths, read-only memory maps of the dataset files
+    global shared_blocks
+    torch.set_num_threads(1)
+
+    # sinks inherited from the driver through fork would only collect spans nobody writes out
+    tracing.tracer.sinks = []
+
+    # LP solutions found by any worker are visible to all (see cvar_lp.Solution_cache)
+    cvar_lp.solution_cache.shared = shared_lp_solutions
+
+    if isinstance(x_shared, str):
+        return portfolio.load_session_data(x_shared, y_shared, mmap=True)
+
+    x_shm, x_data = attach_shared_array(*x_shared)
+    y_shm, y_data = attach_shared_array(*y_shared)
+
+    # keep the mappings alive for the lifetime of the process
+    shared_blocks = (x_shm, y_shm)
+
+    return portfolio.set_session_data(x_data, y_data)
+
+
+class Job:
+
+    # handle of a submitted job, as handed back by wait_any: payload is whatever the executor needs to collect it
+    def __init__(self, payload=None):
+        self.payload = payload
+
+
+class Serial_executor:
+
+    """
+    Everything runs in the driver process, one job after the other -- for debugging
+    """
+
+    num_workers = 1
+
+    def __init__(self, mmap=False):
+        self.mmap = mmap
+        self.completed = deque()
+
+    def start(self, x_samples_filepath, y_samples_filepath, output_dir):
+        portfolio.load_session_data(x_samples_filepath, y_samples_filepath, self.mmap)
+
+    def submit(self, function_name, stage_params_filepath, args):
+        job = Job(run_stage(function_name, stage_params_filepath, *args))
+        self.completed.append(job)
+        return job
+
+    def wait_any(self):
+        return self.completed.popleft()
+
+    def collect(self, job):
+        return job.payload
+
+    def close(self):
+        pass
+
+
+class Process_pool_executor:
+
+    """
+    Local process pool; X/Y are loaded once into shared memory and every worker maps them without copying, or
+    (mmap) every worker memory-maps the dataset files, which the page cache holds once for the whole node
+    """
+
+    def __init__(self, num_workers=None, share_lp_solutions=False, mmap=False):
+        self.num_workers = num_workers if num_workers else int(available_cpu_count())
+        self.share_lp_solutions = share_lp_solutions
+        self.mmap = mmap
+        self.pool = None
+        self.manager = None
+        self.shared_blocks = []
+        # jobs in the order they complete, filled by the pool's result handler thread
+        self.completed = queue.Queue()
+
+    def share_array(self, array):
+
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        self.shared_blocks.append(shm)
+
+        return (shm.name, array.shape, array.dtype.str)
+
+    def start(self, x_samples_filepath, y_samples_filepath, output_dir):
+
+        if self.mmap:
+            x_shared, y_shared = x_samples_filepath, y_samples_filepath
+        else:
+            x_shared = self.share_array(np.load(x_samples_filepath))
+            y_shared = self.share_array(np.load(y_samples_filepath))
+
+        # one LP solution cache for the whole pool, on top of the per-process ones
+        shared_lp_solutions = None
+        if self.share_lp_solutions:
+            self.manager = Manager()
+            shared_lp_solutions = self.manager.dict()
+
+        self.pool = ThreadPool(self.num_workers, initializer=setup_pool_worker,
+                               initargs=(x_shared, y_shared, shared_lp_solutions))
+
+    def submit(self, function_name, stage_params_filepath, args):
+
+        job = Job()
+        job.payload = self.pool.apply_async(run_stage, (function_name, stage_params_filepath) + tuple(args),
+                                            callback=lambda _: self.completed.put(job),
+                                            error_callback=lambda _: self.completed.put(job))
+        return job
+
+    def wait_any(self):
+        return self.completed.get()
+
+    def collect(self, job):
+        return job.payload.get()
+
+    def close(self):
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+
+        for shm in self.shared_blocks:
+            shm.close()
+            shm.unlink()
+        self.shared_blocks = []
+
+
+class Dispy_executor:
+
+    """
+    dispy cluster over the (SSH-launched) dispynodes of the SLURM allocation
+    """
+
+    def __init__(self, compute_nodes_pythonic, mmap=False):
+        self.compute_nodes_pythonic = compute_nodes_pythonic
+        self.mmap = mmap
+        self.cluster = None
+        # jobs in the order they complete, filled by dispy's callback thread
+        self.completed = queue.Queue()
+        # nodes of the allocation are assumed to be alike the one the driver runs on
+        self.num_workers = len(compute_nodes_pythonic) * int(available_cpu_count()) if compute_nodes_pythonic else 1
+
+    def start(self, x_samples_filepath, y_samples_filepath, output_dir):
+
+        # change working directory temporarily to force JobCluster command to dump in the proper output directory
+        original_working_dir = os.getcwd()
+        os.chdir(output_dir + '/' + 'dispy')
+
+        # tell dispy where all the compute nodes are and set them up using setup command
+        self.cluster = dispy.JobCluster(run_stage, nodes=self.compute_nodes_pythonic,
+                                        setup=functools.partial(setup_session, ME_DIR, x_samples_filepath,
+                                                                y_samples_filepath, self.mmap),
+                                        callback=self.job_status)
+
+        # return to original working dir to avoid any unintended effects from dir change
+        os.chdir(original_working_dir)
+
+    def submit(self, function_name, stage_params_filepath, args):
+
+        job = self.cluster.submit(function_name, stage_params_filepath, *args) # it is sent to a node for executing 'compute'
+        job.id = (function_name,) + tuple(args) # store this object for later use
+
+        return job
+
+    def job_status(self, job):
+
+        # called by dispy on every status change of a job; finished or failed jobs are ready to collect
+        if job.status in (dispy.DispyJob.Finished, dispy.DispyJob.Terminated, dispy.DispyJob.Abandoned,
+                          dispy.DispyJob.Cancelled):
+            self.completed.put(job)
+
+    def wait_any(self):
+        return self.completed.get()
+
+    def collect(self, job):
+
+        job() # already finished (see wait_any)
+        if job.status != dispy.DispyJob.Finished:
+            raise RuntimeError('dispy job ' + str(job.id) + ' failed: ' + str(job.exception))
+
+        return job.result
+
+    def close(self):
+
+        if self.cluster is not None:
+            self.cluster.close()
+            self.cluster = None
+
+
+def build_executor(executor="dispy", compute_nodes_pythonic=None, num_workers=None, share_lp_solutions=False,
+                   mmap=False):
+
+    switcher = {
+        "serial": lambda: Serial_executor(mmap),
+        "pool": lambda: Process_pool_executor(num_workers, share_lp_solutions, mmap),
+        "dispy": lambda: Dispy_executor(compute_nodes_pythonic, mmap),
+    }
+
+    try:
+        executor_factory = switcher[executor]
+    except KeyError:
+        print('There is no executor called ', executor)
+        raise
+
+    return executor_factory()
@@ -12,6 +12,10 @@ dy=12
 parser = argparse.ArgumentParser()
 parser.add_argument("-d", "--deterministic", help="make code deterministic by seeding", action="store_true")
 parser.add_argument('-n','--num_samples', type=int, help='number of X/Y samples to generated', required=True)
+parser.add_argument('-c','--chunk_size', type=int, help='stream the samples to memory-mapped outputs, this many at a time (memory use independent of num_samples)')
+parser.add_argument('-r','--replicates', type=int, help='generate this many independent replicate datasets (data/X_nt_replicate_<r>.npy, data/Y_nt_replicate_<r>.npy)')
+parser.add_argument('--first_replicate', type=int, default=0, help='index of the first replicate to generate, to split replicates across processes')
+parser.add_argument('--seed', type=int, help='root seed the replicate streams are spawned from (default: 1 under --deterministic, fresh otherwise)')
 args = parser.parse_args()
 
 if args.deterministic:
@@ -47,17 +51,167 @@ theta2 = np.array([[0,-0.8,0],[-1.1,0,0],[0,0,0]])
 A = 0.025 * np.array([[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8]])
 B = 0.075 * np.array([[0,-1,-1],[-1,0,-1],[-1,-1,0],[0,-1,1],[-1,0,1],[-1,1,0],[0,1,-1],[1,0,-1],[1,-1,0],[0,1,1],[1,0,1],[1,1,0]])
 
-# Get 100,000 samples of the U process (each row is a sample)
+def covariates(U, U_history, X_history, start):
+
+  """
+  Arguments:
+
+      U: rows [start, start+len(U)) of the U process (leading axes, if any, are independent series, eg replicates)
+      U_history, X_history: the (up to two) rows of U and X just before start -- empty when start is 0
+      start: index of the first row of U in the whole series
+
+  Returns:
+
+      X: rows [start, start+len(U)) of the covariates (same shape as U)
+
+  Description:
+
+      X follows a VARMA(2,2) driven by U:
+        X[i] = U[i] + theta1 U[i-1] + theta2 U[i-2] + phi1 X[i-1] + phi2 X[i-2]
+      All products are batched np.matmul calls, which evaluate every row exactly like the per-row
+      np.matmul(theta1, U[i-1]) etc, so the output is bit-for-bit that of the per-row loop for the same seed,
+      and the same whether the series is generated at once or chunk by chunk.
+  """
+  history = U_history.shape[-2]
+  num_rows = U.shape[-2]
+  U_all = np.concatenate([U_history, U], -2)
+  X_all = np.concatenate([X_history, np.zeros_like(U)], -2)
+
+  # 1. moving average part, all rows at once (same order of additions as the recursion)
+  M = U_all.copy()
+  M[..., 1:, :] += np.matmul(theta1, U_all[..., :-1, :, None])[..., 0]
+  M[..., 2:, :] += np.matmul(theta2, U_all[..., :-2, :, None])[..., 0]
+
+  # first two rows of the series
+  first = history
+  if start == 0 and num_rows > 0:
+    X_all[..., 0, :] = U_all[..., 0, :]
+    first = 1
+  if start <= 1 and num_rows > 1 - start:
+    # note: np.matmul(ph1, X[0] = npmatmu(X[0],np.transpose(phi1))
+    X_all[..., 1, :] = np.matmul(phi1, X_all[..., 0, :, None])[..., 0] + U_all[..., 1, :] + np.matmul(theta1, U_all[..., 0, :, None])[..., 0]
+    first = 2
+
+  # 2. autoregressive part: inherently sequential -- a parallel scan would change the rounding -- so each step
+  # is kept to one batched product of (phi2, phi1) with (X[i-2], X[i-1]) and two in-place additions
+  # (all series advance together, so the Python loop is over time only)
+  phi = np.stack([phi2, phi1])
+  ar_terms = np.empty(U.shape[:-2] + (2, dx, 1))
+  X_columns = X_all[..., None]
+  for i in range(first, X_all.shape[-2]):
+    np.matmul(phi, X_columns[..., i-2:i, :, :], out=ar_terms)
+    np.add(M[..., i, :], ar_terms[..., 1, :, 0], out=X_all[..., i, :])
+    np.add(X_all[..., i, :], ar_terms[..., 0, :, 0], out=X_all[..., i, :])
+
+  return X_all[..., history:, :]
+
+
+def responses(X, delta, epsilon):
+
+  # Y[i] = X[i] A^T + (sum(A)/4) delta[i] + (X[i] B^T) epsilon[i], all rows at once
+  return np.matmul(X[..., None, :], np.transpose(A))[..., 0, :] + np.multiply(np.sum(A,axis=1), delta/4) + np.multiply(np.matmul(X[..., None, :], np.transpose(B))[..., 0, :], epsilon)
+
+
+def skip_normals(random_state, num_samples, dimension, chunk_size):
+
+  # draws (and drops) num_samples x dimension standard normals, chunk by chunk, to move the stream past them
+  for chunk_start in range(0, num_samples, chunk_size):
+    random_state.standard_normal((min(chunk_size, num_samples - chunk_start), dimension))
+
+
+def generate_streaming(num_samples, chunk_size, x_filepath, y_filepath):
+
+  """
+  Same output as the in-memory path for the same seed, with memory in O(chunk_size) whatever num_samples:
+
+      -- U, delta and epsilon are drawn from one random stream in that order, so the stream is forked in three:
+         the delta and epsilon forks start where the in-memory path starts drawing them (found by drawing and
+         dropping the normals before them, chunk by chunk)
+      -- the last two rows of U and X are carried across chunk boundaries
+      -- X and Y are written into preallocated memory-mapped .npy files
+  """
+  u_stream = np.random.RandomState()
+  u_stream.set_state(np.random.get_state())
+
+  skip_stream = np.random.RandomState()
+  skip_stream.set_state(np.random.get_state())
+  skip_normals(skip_stream, num_samples, dx, chunk_size)
+  delta_stream = np.random.RandomState()
+  delta_stream.set_state(skip_stream.get_state())
+  skip_normals(skip_stream, num_samples, dy, chunk_size)
+  epsilon_stream = skip_stream
+
+  X_out = np.lib.format.open_memmap(x_filepath, mode='w+', dtype=np.float64, shape=(num_samples, dx))
+  Y_out = np.lib.format.open_memmap(y_filepath, mode='w+', dtype=np.float64, shape=(num_samples, dy))
+
+  U_history = np.zeros([0, dx])
+  X_history = np.zeros([0, dx])
+  for chunk_start in range(0, num_samples, chunk_size):
+    chunk_stop = min(chunk_start + chunk_size, num_samples)
+
+    U = u_stream.multivariate_normal(np.zeros(dx), sigma_u, chunk_stop - chunk_start)
+    X = covariates(U, U_history, X_history, chunk_start)
+
+    delta = delta_stream.standard_normal((chunk_stop - chunk_start, dy))
+    epsilon = epsilon_stream.standard_normal((chunk_stop - chunk_start, dy))
+
+    X_out[chunk_start:chunk_stop] = X
+    Y_out[chunk_start:chunk_stop] = responses(X, delta, epsilon)
+
+    U_history = np.concatenate([U_history, U])[-2:]
+    X_history = np.concatenate([X_history, X])[-2:]
+
+  X_out.flush()
+  Y_out.flush()
+
+
+def generate_replicates(num_samples, num_replicates, first_replicate, root_seed, x_filepath_format, y_filepath_format):
+
+  """
+  Replicates [first_replicate, first_replicate+num_replicates) of the dataset, in one call:
+
+      -- replicate r draws U, delta and epsilon from its own stream, seeded by child r of the root seed
+         (SeedSequence spawning), so a replicate is the same whichever call (or process) generates it
+      -- the VARMA recursion of every replicate advances in lockstep along a replicate axis
+  """
+  seed_sequences = [np.random.SeedSequence(root_seed, spawn_key=(r,))
+                    for r in range(first_replicate, first_replicate + num_replicates)]
+  streams = [np.random.default_rng(seed_sequence) for seed_sequence in seed_sequences]
+
+  U = np.stack([stream.multivariate_normal(np.zeros(dx), sigma_u, num_samples) for stream in streams])
+  delta = np.stack([stream.standard_normal((num_samples, dy)) for stream in streams])
+  epsilon = np.stack([stream.standard_normal((num_samples, dy)) for stream in streams])
+
+  X = covariates(U, np.zeros([num_replicates, 0, dx]), np.zeros([num_replicates, 0, dx]), 0)
+  Y = responses(X, delta, epsilon)
+
+  for replicate_index, r in enumerate(range(first_replicate, first_replicate + num_replicates)):
+    np.save(x_filepath_format.format(r), X[replicate_index])
+    np.save(y_filepath_format.format(r), Y[replicate_index])
+
+
 num_samples=args.num_samples
-U = np.random.multivariate_normal(np.zeros(dx), sigma_u, num_samples)
 
-X = np.zeros([num_samples, dx])
-X[0] = U[0]
-# note: np.matmul(ph1, X[0] = npmatmu(X[0],np.transpose(phi1))
-X[1] = np.matmul(phi1, X[0]) + U[1] + np.matmul(theta1, U[0])
+if args.replicates:
+  # root seed: fixed under --deterministic, otherwise fresh and printed so the replicates can be regenerated
+  root_seed = args.seed if args.seed is not None else (1 if args.deterministic else np.random.SeedSequence().entropy)
+  print('Replicates ' + str(args.first_replicate) + ' to ' + str(args.first_replicate + args.replicates - 1) + ' of root seed ' + str(root_seed))
+  generate_replicates(num_samples, args.replicates, args.first_replicate, root_seed,
+                      'data/X_nt_replicate_{}.npy', 'data/Y_nt_replicate_{}.npy')
+  te = time()
+  print('Finished gen_data for ' + str(args.replicates) + ' x ' + str(num_samples) + ' samples: took %2.4f seconds.' % (te-ts))
+  exit()
+
+if args.chunk_size:
+  generate_streaming(num_samples, args.chunk_size, 'data/X_nt.npy', 'data/Y_nt.npy')
+  te = time()
+  print('Finished gen_data for ' + str(num_samples) + ' samples: took %2.4f seconds.' % (te-ts))
+  exit()
+
+# Get 100,000 samples of the U process (each row is a sample)
+U = np.random.multivariate_normal(np.zeros(dx), sigma_u, num_samples)
 
-for i in range(2, num_samples):
-  X[i] = U[i] + np.matmul(theta1, U[i-1]) + np.matmul(theta2, U[i-2]) + np.matmul(phi1, X[i-1]) + np.matmul(phi2, X[i-2])
+X = covariates(U, np.zeros([0, dx]), np.zeros([0, dx]), 0)
 
 delta = np.random.standard_normal((num_samples, dy))
 epsilon =  np.random.standard_normal((num_samples, dy))
@@ -66,11 +220,7 @@ epsilon =  np.random.standard_normal((num_samples, dy))
 #print(U[0])
 #exit()
 
-Y = np.zeros([num_samples, dy])
-for i in range(0, num_samples):
-  # note X[i][:,none] is the weird numpy way of doing transpose of X[i] (because 1d-array)
-  # probably there's a more efficient ways to do this using broadcasting
-  Y[i] = np.matmul(X[i], np.transpose(A)) + np.multiply(np.sum(A,axis=1), delta[i]/4) + np.multiply(np.matmul(X[i], np.transpose(B)), epsilon[i])
+Y = responses(X, delta, epsilon)
 
 # checked with
 #for j in range(100000):
@@ -0,0 +1,373 @@
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+import telemetry
+
+# points whose distance is within this tolerance of the kth nearest neighbor are kept as ties
+TIE_TOLERANCE = 1e-7
+
+# upper bound on the size of the (queries x samples) distance matrix built at any one time
+DEFAULT_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def whiten(x_tensor, lower_diag):
+    """
+    Arguments:
+
+        x_tensor: covariates, one sample per row
+        lower_diag: lower triangular Cholesky factor of the mahalanobis matrix
+
+    Returns:
+
+        z_tensor: covariates in whitened coordinates, ie L^-1 x for each row x
+
+    Description:
+
+        Mahalanobis distance between two points is the euclidean distance between their whitened
+        coordinates, so X can be whitened once per Cholesky factor instead of once per query.
+    """
+    with telemetry.job.phase("triangular_solve"):
+        return torch.trtrs(x_tensor.transpose(0, 1), lower_diag, upper=False)[0].transpose(0, 1)
+
+
+def distances(z_tensor, zbar_block):
+
+    # accumulate squared differences one covariate at a time to avoid a (queries x samples x covariates) temporary
+    squared_distances = torch.zeros(zbar_block.size(0), z_tensor.size(0), dtype=z_tensor.dtype)
+    for covariate in range(z_tensor.size(1)):
+        squared_distances += (z_tensor[:, covariate].unsqueeze(0) - zbar_block[:, covariate].unsqueeze(1)) ** 2
+
+    return torch.sqrt(squared_distances)
+
+
+def inclusive_nearest_neighbors(z_tensor, zbar_block, k):
+    """
+    Arguments:
+
+        z_tensor: whitened historical covariates (num_samples x num_covariates)
+        zbar_block: whitened contexts of interest (num_queries x num_covariates)
+        k: number of nearest neighbors
+
+    Returns:
+
+        sorted_distances: distance of each query to its nearest neighbors, ascending (num_queries x max_inclusive_k)
+        sorted_indices: row of z_tensor of each nearest neighbor (num_queries x max_inclusive_k)
+        inclusive_k: number of nearest neighbors of each query once ties are included (num_queries)
+
+    Description:
+
+        1. Partially select the k nearest neighbors of each query (no full sort of all distances)
+        2. Adjust k so that points just outside the k-set which have the same distance as the kth point
+           are included -- the boundary is the kth distance plus TIE_TOLERANCE
+        3. Row i only holds inclusive_k[i] valid neighbors, the remaining columns are those of the
+           next nearest points and must be masked out by the caller
+    """
+    num_samples = z_tensor.size(0)
+    k = min(int(k), num_samples)
+
+    with telemetry.job.phase("distances"):
+        block_distances = distances(z_tensor, zbar_block)
+
+    with telemetry.job.phase("sort"):
+        sorted_distances, sorted_indices = torch.topk(block_distances, k, dim=1, largest=False, sorted=True)
+
+    # adjust k to avoid eliminating equi-distant points
+    inclusive_distance_boundary = sorted_distances[:, k - 1] + TIE_TOLERANCE
+    inclusive_k = (block_distances <= inclusive_distance_boundary.unsqueeze(1)).long().sum(1)
+
+    # only select further if some query has ties beyond the kth point
+    max_inclusive_k = int(inclusive_k.max())
+    if max_inclusive_k > k:
+        with telemetry.job.phase("sort"):
+            sorted_distances, sorted_indices = torch.topk(block_distances, max_inclusive_k, dim=1, largest=False,
+                                                          sorted=True)
+
+    return sorted_distances, sorted_indices, inclusive_k
+
+
+class Brute_force_neighbors:
+    """
+    Exhaustive nearest neighbor search: distances from each query to every sample, then partial selection
+    """
+
+    def __init__(self, z_tensor):
+        self.z_tensor = z_tensor
+        self.num_samples = z_tensor.size(0)
+
+    def query_block_size(self, k, max_block_bytes=DEFAULT_BLOCK_BYTES):
+
+        # a few (queries x samples) double-precision temporaries are alive at once in distances()
+        return max(1, int(max_block_bytes // (4 * 8 * max(self.num_samples, 1))))
+
+    def query(self, zbar_block, k):
+        return inclusive_nearest_neighbors(self.z_tensor, zbar_block, k)
+
+
+class Kd_tree_neighbors:
+    """
+    KD-tree over the whitened covariates: mahalanobis distance is euclidean in whitened coordinates, and the
+    covariate space is low dimensional, so each query only visits a small part of the samples
+    """
+
+    def __init__(self, z_tensor, leafsize=16):
+        self.tree = cKDTree(z_tensor.numpy(), leafsize=leafsize)
+        self.num_samples = z_tensor.size(0)
+
+    def query_block_size(self, k, max_block_bytes=DEFAULT_BLOCK_BYTES):
+
+        # memory per query is only that of its neighbors (distances, indices and gathered responses)
+        return max(1, int(max_block_bytes // (128 * max(int(k), 1))))
+
+    def query(self, zbar_block, k):
+
+        with telemetry.job.phase("kd_tree_query"):
+            return self.query_tree(zbar_block, k)
+
+    def query_tree(self, zbar_block, k):
+
+        # same contract as inclusive_nearest_neighbors
+        zbar = zbar_block.numpy()
+        k = min(int(k), self.num_samples)
+
+        # k=1 returns 1-d arrays, hence the reshape
+        sorted_distances, sorted_indices = self.tree.query(zbar, k)
+        sorted_distances = sorted_distances.reshape(len(zbar), -1)
+
+        # adjust k to avoid eliminating equi-distant points
+        inclusive_distance_boundary = sorted_distances[:, k - 1] + TIE_TOLERANCE
+        inclusive_k = self.tree.query_ball_point(zbar, inclusive_distance_boundary, return_length=True)
+        inclusive_k = np.maximum(inclusive_k, k)
+
+        # only search further if some query has ties beyond the kth point
+        max_inclusive_k = int(np.max(inclusive_k))
+        if max_inclusive_k > k:
+            sorted_distances, sorted_indices = self.tree.query(zbar, max_inclusive_k)
+
+        return torch.from_numpy(sorted_distances.reshape(len(zbar), -1)), \
+               torch.from_numpy(sorted_indices.reshape(len(zbar), -1).astype(np.int64)), \
+               torch.from_numpy(np.asarray(inclusive_k, dtype=np.int64))
+
+
+def build_neighbors(z_tensor, backend="brute"):
+
+    switcher = {
+        "brute": Brute_force_neighbors,
+        "kd_tree": Kd_tree_neighbors,
+    }
+
+    try:
+        neighbors_class = switcher[backend]
+    except KeyError:
+        print('There is no neighbor backend called ', backend)
+        raise
+
+    with telemetry.job.phase("neighbor_index"):
+        return neighbors_class(z_tensor)
+
+
+def neighbor_mask(inclusive_k, num_columns):
+
+    # mask[i, j] is 1 if column j of row i is one of the inclusive_k[i] nearest neighbors
+    return (torch.arange(num_columns).long().unsqueeze(0) < inclusive_k.unsqueeze(1))
+
+
+def neighbor_weights(sorted_distances, inclusive_k, weighter=None):
+    """
+    Arguments:
+
+        sorted_distances: distance of each query to its nearest neighbors, ascending (num_queries x num_columns)
+        inclusive_k: number of valid nearest neighbors of each query (num_queries)
+        weighter: maps a block of distances to smoother coefficients (eg Smoother.weights at some bandwidth),
+                  None for the naive smoother
+
+    Returns:
+
+        weights: weight of each column, zero beyond the inclusive k nearest neighbors (num_queries x num_columns)
+
+    Description:
+
+        Queries whose neighbors all get a zero weight (compactly supported smoother and a bandwidth shorter than
+        the nearest neighbor) fall back to equal weights rather than dividing by zero.
+    """
+    mask = neighbor_mask(inclusive_k, sorted_distances.size(1)).type_as(sorted_distances)
+    if weighter is None:
+        return mask
+
+    weights = weighter(sorted_distances).type_as(sorted_distances) * mask
+    no_weight = (torch.sum(weights, 1) <= 0).unsqueeze(1).type_as(weights)
+
+    return weights + no_weight * mask
+
+
+def expected_losses(neighbors, y_tensor, zbar_tensor, k, loss_function, max_block_bytes=DEFAULT_BLOCK_BYTES,
+                    weighter=None, num_decisions=None):
+    """
+    Arguments:
+
+        neighbors: nearest neighbor backend built over the whitened historical covariates (see build_neighbors)
+        y_tensor: historical responses (num_samples x num_assets)
+        zbar_tensor: whitened contexts of interest (num_queries x num_covariates)
+        k: number of nearest neighbors
+        loss_function: loss_function(start, stop, nearest_neighbors) gives the loss of the decision of each query
+                       of [start, stop) against each of its neighbor responses
+                       ((stop-start) x num_neighbors x num_assets -> (stop-start) x num_neighbors), or of each of
+                       its num_decisions decisions (-> (stop-start) x num_neighbors x num_decisions)
+        max_block_bytes: memory budget of one block of queries
+        weighter: smoother coefficients of a block of distances (see neighbor_weights), None for the naive mean
+        num_decisions: number of decisions of each query evaluated by loss_function, None if loss_function has no
+                       decision axis
+
+    Returns:
+
+        expected_losses: weighted mean loss over the inclusive k nearest neighbors of each query (num_queries),
+                         for each decision if loss_function has a decision axis (num_queries x num_decisions)
+
+    Description:
+
+        Each query has its own decision (eg a portfolio), so losses are only evaluated against that query's
+        neighbors, never against the whole of Y.
+    """
+    num_observations = zbar_tensor.size(0)
+    num_assets = y_tensor.size(1)
+
+    # gathered responses and losses of a block must fit in the budget as well as the neighbor search
+    gathered_bytes = 8 * (num_assets + 2 * (num_decisions or 1)) * max(min(int(k), neighbors.num_samples), 1)
+    block_size = max(1, min(neighbors.query_block_size(k, max_block_bytes), int(max_block_bytes // gathered_bytes)))
+
+    # a decision axis is kept even if it has a single decision (eg a learning curve with one size)
+    decision_shape = (num_decisions,) if num_decisions is not None else ()
+    expected_losses_tensor = torch.empty((num_observations,) + decision_shape, dtype=y_tensor.dtype)
+    for start in range(0, num_observations, block_size):
+        stop = min(start + block_size, num_observations)
+
+        sorted_distances, sorted_indices, inclusive_k = neighbors.query(zbar_tensor[start:stop], k)
+
+        nearest_neighbors = y_tensor[sorted_indices.view(-1)].view(stop - start, -1, num_assets)
+        losses = loss_function(start, stop, nearest_neighbors)
+        weights = neighbor_weights(sorted_distances, inclusive_k, weighter).type_as(losses)
+        # the same weights for every decision of a query
+        weights = weights.view(weights.shape + (1,) * (losses.dim() - 2))
+
+        expected_losses_tensor[start:stop] = torch.sum(losses * weights, 1) / torch.sum(weights, 1)
+
+    return expected_losses_tensor
+
+
+def nearest_neighbor_indices(neighbors, zbar, k):
+
+    # rows of the inclusive k nearest neighbors of a single context, nearest first
+    _, sorted_indices, inclusive_k = neighbors.query(zbar.view(1, -1), k)
+
+    return sorted_indices[0, :int(inclusive_k[0])]
+
+
+def expected_responses_sweep(neighbors, y_tensor, zbar_tensor, k_list, weighters=(None,),
+                             max_block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Arguments:
+
+        neighbors: nearest neighbor backend built over the whitened historical covariates (see build_neighbors)
+        y_tensor: historical responses (num_samples x num_assets)
+        zbar_tensor: whitened contexts of interest (num_queries x num_covariates)
+        k_list: numbers of nearest neighbors to evaluate
+        weighters: smoothers (at their bandwidth) to evaluate, see neighbor_weights -- None is the naive smoother
+        max_block_bytes: memory budget of one block of queries
+
+    Yields:
+
+        (start, stop, expected_responses): for each block of queries [start, stop), the weighted mean response of
+                                           the inclusive k nearest neighbors of each query, for each weighter and
+                                           each k in k_list (len(weighters) x len(k_list) x block x num_assets)
+
+    Description:
+
+        The neighbor ordering and distances are computed once per block, up to max(k_list) (plus ties). Weights
+        only depend on distances, so each weighter is evaluated once over the whole sorted block, and the
+        weighted mean for any k is a ratio of running sums of the weighted responses and of the weights, read
+        at that k's inclusive count. Every (weighter, k) combination then costs a gather, not a neighbor pass.
+    """
+    num_observations = zbar_tensor.size(0)
+    num_assets = y_tensor.size(1)
+    k_list = [min(int(k), neighbors.num_samples) for k in k_list]
+    max_k = max(k_list)
+
+    # the block of results must fit in the budget as well as the neighbor search
+    result_bytes = 8 * num_assets * (len(weighters) * len(k_list) + 2 * max_k)
+    block_size = max(1, min(neighbors.query_block_size(max_k, max_block_bytes), int(max_block_bytes // result_bytes)))
+
+    for start in range(0, num_observations, block_size):
+        stop = min(start + block_size, num_observations)
+
+        sorted_distances, sorted_indices, _ = neighbors.query(zbar_tensor[start:stop], max_k)
+        nearest_neighbors = y_tensor[sorted_indices.view(-1)].view(stop - start, -1, num_assets)
+
+        # adjust k to avoid eliminating equi-distant points; every point within the boundary is
+        # among the sorted columns since the boundary of max_k is at least as far
+        last_neighbors = []
+        for k in k_list:
+            inclusive_distance_boundary = sorted_distances[:, k - 1] + TIE_TOLERANCE
+            inclusive_k = (sorted_distances <= inclusive_distance_boundary.unsqueeze(1)).long().sum(1)
+            last_neighbors.append(inclusive_k - 1)
+
+        # naive running sums, also the fallback of queries whose neighbors all get a zero weight
+        naive_response_sums = torch.cumsum(nearest_neighbors, 1)
+        naive_weight_sums = torch.cumsum(torch.ones_like(sorted_distances), 1)
+
+        expected_responses_tensor = torch.empty(len(weighters), len(k_list), stop - start, num_assets,
+                                                dtype=y_tensor.dtype)
+        for weighter_index, weighter in enumerate(weighters):
+
+            # running sums over the sorted neighbors: column j holds the sum over the j+1 nearest
+            if weighter is None:
+                response_sums, weight_sums = naive_response_sums, naive_weight_sums
+            else:
+                weights = weighter(sorted_distances).type_as(nearest_neighbors)
+                response_sums = torch.cumsum(nearest_neighbors * weights.unsqueeze(2), 1)
+                weight_sums = torch.cumsum(weights, 1)
+
+            for k_index, last_neighbor in enumerate(last_neighbors):
+
+                weight_sum = weight_sums.gather(1, last_neighbor.unsqueeze(1))
+                response_sum = response_sums.gather(1, last_neighbor.view(-1, 1, 1).expand(stop - start, 1,
+                                                                                          num_assets)).squeeze(1)
+
+                if weighter is not None:
+                    no_weight = weight_sum <= 0
+                    if no_weight.any():
+                        naive_sum = naive_response_sums.gather(1, last_neighbor.view(-1, 1, 1).expand(
+                            stop - start, 1, num_assets)).squeeze(1)
+                        response_sum = torch.where(no_weight, naive_sum, response_sum)
+                        weight_sum = torch.where(no_weight, (last_neighbor + 1).unsqueeze(1).type_as(weight_sum),
+                                                 weight_sum)
+
+                expected_responses_tensor[weighter_index, k_index] = response_sum / weight_sum
+
+        yield start, stop, expected_responses_tensor
+
+
+def squared_errors_sweep(neighbors, y_tensor, zbar_tensor, ybar_tensor, k_list, weighters=(None,),
+                         max_block_bytes=DEFAULT_BLOCK_BYTES):
+    """
+    Arguments:
+
+        neighbors, y_tensor, zbar_tensor, k_list, weighters, max_block_bytes: see expected_responses_sweep
+        ybar_tensor: true responses of the contexts of interest (num_queries x num_assets)
+
+    Returns:
+
+        squared_errors: sum over the queries of the squared distance between the true and the expected response,
+                        for each weighter and each k (len(weighters) x len(k_list))
+
+    Description:
+
+        Scores of a hyperparameter search: only the (weighters x k) sums leave the block, never the expected
+        responses themselves.
+    """
+    ybar_tensor = ybar_tensor.view(ybar_tensor.size(0), -1)
+
+    squared_errors = torch.zeros(len(weighters), len(k_list), dtype=y_tensor.dtype)
+    for start, stop, block in expected_responses_sweep(neighbors, y_tensor, zbar_tensor, k_list, weighters,
+                                                       max_block_bytes):
+        squared_errors += torch.sum((ybar_tensor[start:stop] - block) ** 2, (2, 3))
+
+    return squared_errors
@@ -0,0 +1,72 @@
+import random
+import numpy as np
+
+
+class Nested_training_sets:
+
+    """
+    One draw of nested training sets for a learning curve:
+
+        -- the training set of every size is a prefix of a single ordering of the dataset, so each larger
+           training set extends the previous one; the validation set is the rest of the dataset
+        -- within a training set, every validation_period-th sample of the ordering is held out for the
+           hyperparameter search, so the inner training and validation sets are nested too
+
+    In deterministic (sanity/short) mode the ordering is that of the dataset, like split_data.
+    """
+
+    def __init__(self, num_samples_in_dataset, p=0.2, deterministic=False):
+
+        if deterministic:
+            self.order = np.arange(num_samples_in_dataset)
+        else:
+            self.order = np.asarray(random.sample(range(num_samples_in_dataset), num_samples_in_dataset))
+
+        # about a proportion p of every prefix, and at least one sample as soon as there is one
+        self.validation_period = max(2, int(round(1/p)))
+
+    def training_indices(self, num_samples):
+        return self.order[:num_samples]
+
+    def validation_indices(self, num_samples):
+        return np.sort(self.order[num_samples:])
+
+    def inner_split(self, num_samples):
+
+        # positions within the training set of size num_samples (as used by compute_hyperparameters)
+        positions = np.arange(num_samples)
+        inner_validation = positions % self.validation_period == 0
+
+        return positions[~inner_validation], positions[inner_validation]
+
+
+class Running_covariance:
+
+    """
+    Covariance of a growing set of samples, updated from the new samples only. Sums are accumulated around the
+    first sample seen to avoid cancellation when the covariates are far from zero.
+    """
+
+    def __init__(self, num_covariates):
+        self.count = 0
+        self.shift = None
+        self.sum = np.zeros(num_covariates)
+        self.sum_outer = np.zeros((num_covariates, num_covariates))
+
+    def extend(self, X_new):
+
+        if len(X_new) == 0:
+            return
+        if self.shift is None:
+            self.shift = np.array(X_new[0], dtype=np.float64)
+
+        centered = X_new - self.shift
+        self.count += len(X_new)
+        self.sum += centered.sum(0)
+        self.sum_outer += centered.T @ centered
+
+    def covariance(self):
+
+        # same as np.cov(X.T, bias=True) over all samples added so far
+        mean = self.sum / self.count
+        return self.sum_outer / self.count - np.outer(mean, mean)
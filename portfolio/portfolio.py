@@ -5,217 +5,275 @@ import cvxpy as cp
 import value_at_risk
 import smoother
 import hyperparameters
+import knn
+import cvar_lp
+import scheduling
+import learning_curve
+import artifact_cache
+import compute_session
 import logging
-from decorators import timed, profile
+import tracing
+import telemetry
+from decorators import timed
 import torch
-from available_cpu_count import available_cpu_count
 from time import time
 import os
+import warnings
 # import inspect
-import itertools
-from multiprocessing import Pool as ThreadPool
-import dill as pkl
-import dispy
-import functools
 import time
 
 ME_DIR = os.path.dirname(os.path.realpath(__file__))
 
-def setup_expected_responses(generated_data_filepath):
+def load_session_data(x_samples_filepath, y_samples_filepath, mmap=False):
 
-    #global random, np, sqrt, floor, ceil, cp, torch, os
-    #import random
-    #import numpy as np
-    #from math import sqrt, floor, ceil
-    #import cvxpy as cp
-    #import torch
-    #import os
+    # called once per worker (or node) by the executor: the dataset stays resident for every stage;
+    # memory-mapped read-only, every process of a node shares the one page-cached copy
+    mmap_mode = 'r' if mmap else None
+    return set_session_data(np.load(x_samples_filepath, mmap_mode=mmap_mode),
+                            np.load(y_samples_filepath, mmap_mode=mmap_mode))
 
-    #import torch
+def set_session_data(x, y):
 
-    global np, os, torch
-    import torch
-    import numpy as np
-    import os
+    global x_data, y_data, stage
 
-    global x_tensor, y_tensor, k, lower_diag, xbar_tensor
-    #global x, y, k, lower_diag_np, xbar_np
-
-    compute_expected_responses_params = np.load(generated_data_filepath)
-
-    k = compute_expected_responses_params['k']
-    lower_diag = torch.from_numpy(compute_expected_responses_params['lower_diag'])
-    x_tensor = torch.from_numpy(compute_expected_responses_params['x'])
-    y_tensor = torch.from_numpy(compute_expected_responses_params['y'])
-    xbar_tensor = torch.from_numpy(compute_expected_responses_params['xbar'])
-
-    #lower_diag_np = compute_expected_responses_params['lower_diag']
-    #x = compute_expected_responses_params['x']
-    #y = compute_expected_responses_params['y']
-    #xbar_np = compute_expected_responses_params['xbar']
+    x_data = x
+    y_data = y
+    stage = None
 
     return 0
 
-def compute_expected_response(j):
-
-    #import torch
+def shared_tensor(array):
+
+    # tensor over the buffer of array, without copying it; mapped datasets are read-only, which torch warns
+    # about, but tensors of the dataset are never written to
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(np.asarray(array))
+
+def weighter_function(smoother_name, bandwidth):
+
+    # block of neighbor distances -> smoother coefficients (see knn.neighbor_weights); None for the naive mean
+    if smoother_name == "Naive":
+        return None
+
+    stage_smoother = smoother.Smoother(smoother_name)
+    return lambda distances: stage_smoother.weights(distances, bandwidth)
+
+def load_stage(stage_params_filepath):
+
+    """
+    Arguments:
+
+        stage_params_filepath: small npz written by Compute_session.write_stage_params (its large arrays are
+                               stored alongside, see artifact_cache.py)
+
+    Returns:
+
+        stage: dictionary of everything the worker functions need for this stage
+
+    Description:
+
+        Rows of the resident dataset are referenced by indices (x_indices, y_indices, xbar_indices), anything
+        else (eg losses) is shipped as an array (x, y, xbar). The covariates are whitened and the neighbor index
+        is built once per stage, and kept until the next stage comes along.
+    """
+    global stage
+
+    if stage is not None and stage['filepath'] == stage_params_filepath:
+        return stage
+
+    stage_params = artifact_cache.load_stage_params(stage_params_filepath)
+
+    def stage_array(name, data):
+        if name + '_indices' in stage_params:
+            indices = stage_params[name + '_indices']
+            # the whole dataset in order is used as is: no private copy of a shared (or mapped) array
+            if len(indices) == len(data) and np.array_equal(indices, np.arange(len(data))):
+                return data
+            return data[indices]
+        return stage_params[name]
+
+    x = stage_array('x', x_data)
+    y = stage_array('y', y_data)
+    xbar = stage_array('xbar', x_data)
+
+    lower_diag = torch.from_numpy(stage_params['lower_diag'])
+
+    # 1-d responses (eg losses) are treated as a single asset
+    y_tensor = shared_tensor(y)
+    y_tensor = y_tensor.view(y_tensor.size(0), -1)
+
+    # whiten and build the neighbor index (if any) once per Cholesky factor
+    neighbors = knn.build_neighbors(knn.whiten(shared_tensor(x), lower_diag), str(stage_params['neighbor_backend']))
+    zbar_tensor = knn.whiten(shared_tensor(xbar.reshape(-1, x.shape[1])), lower_diag)
+
+    stage = {'filepath': stage_params_filepath, 'k': stage_params['k'], 'neighbors': neighbors, 'y_tensor': y_tensor,
+             'zbar_tensor': zbar_tensor}
+    for name in ['epsilon', '__lambda']:
+        if name in stage_params:
+            stage[name] = stage_params[name]
+    stage['lp_solver'] = str(stage_params['lp_solver']) if 'lp_solver' in stage_params else "ecos"
+    stage['max_block_bytes'] = int(stage_params['max_block_bytes']) if 'max_block_bytes' in stage_params \
+                               else knn.DEFAULT_BLOCK_BYTES
+    # neighbor weights of non-naive smoothers (see knn.neighbor_weights), at the bandwidth of the hyperparameters
+    stage['weighter'] = None
+    if 'smoother' in stage_params:
+        stage['weighter'] = weighter_function(str(stage_params['smoother']), float(stage_params['bandwidth']))
+    # (smoother, bandwidth) pairs of a hyperparameter search, and the true responses they are scored against
+    if 'sweep_smoothers' in stage_params:
+        stage['weighters'] = [weighter_function(str(name), float(bandwidth)) for name, bandwidth in
+                              zip(stage_params['sweep_smoothers'], stage_params['sweep_bandwidths'])]
+        stage['ybar_tensor'] = shared_tensor(stage_array('ybar', y_data))
+    # decision of each context of interest, for stages which evaluate given portfolios
+    for name in ['portfolios', 'value_at_risks']:
+        if name in stage_params:
+            stage[name] = torch.from_numpy(stage_params[name])
+    # position i of a chunk is query query_order[i] (see Nearest_neighbors_portfolio.locality_order)
+    stage['query_order'] = stage_params['query_order'] if 'query_order' in stage_params else None
+    # neighbor rows as rows of the resident dataset, so LP solutions can be reused across stages (see
+    # compute_optimal_portfolio); responses shipped with the stage are only comparable within the stage
+    if 'y_indices' in stage_params:
+        stage['y_rows'], stage['y_source'] = stage_params['y_indices'], "dataset"
+    else:
+        stage['y_rows'], stage['y_source'] = np.arange(len(y)), stage_params_filepath
+
+    return stage
+
+def compute_squared_errors_sweep(stage_params_filepath, start, stop):
 
     os.environ["OMP_NUM_THREADS"] = "1"
 
-    #lower_diag = torch.from_numpy(lower_diag_np)
-    #x_tensor = torch.from_numpy(x)
-    #y_tensor = torch.from_numpy(y)
-    #xbar_tensor = torch.from_numpy(xbar_np)
-
-    ## Context of interest
-    xbar = xbar_tensor[j]
-
-    ### COMPUTE SORTED NEAREST NEIGHBOR
-    Xsub = (x_tensor - xbar).transpose(0, 1)
-
-    Z = torch.trtrs(Xsub, lower_diag, upper=False)[0].transpose(0, 1)
-
-    # mahalanobis_distances: mahalanobis distance of each X vector to Xbar
-    mahalanobis_distances = torch.norm(Z, p=2, dim=1)
+    with telemetry.job.phase("load_stage"):
+        stage = load_stage(stage_params_filepath)
 
-    ## SORT the data based on distance to xbar
-    mahalanobis_distances_sorted, sorted_indices = torch.sort(mahalanobis_distances, 0)
-
-    Y_sorted = y_tensor[sorted_indices]  # now local scope
-
-    # adjust k to avoid eliminating equi-distant points
-    inclusive_distance_boundary = mahalanobis_distances_sorted[k - 1] + 1e-7
-
-    # cast to int because of weird incompatibility between zero-dim tensor and int in pytorch 0.4.0
-    inclusive_k = int(np.searchsorted(mahalanobis_distances_sorted, inclusive_distance_boundary, side='right'))
-
-    # get indices of nearest neighbors
-    inclusive_k_nearest_neighbor_indices = np.arange(inclusive_k)
-
-    sorted_nn_tensor = Y_sorted[inclusive_k_nearest_neighbor_indices]
-    ### DONE COMPUTE SORTED NEAREST NEIGHBOR
+    ## Contexts of interest: block of queries [start, stop), scored for every (smoother, bandwidth) and every k
+    # (the neighbor search is timed by its own phases, see knn.py)
+    with telemetry.job.phase("squared_errors_sweep"):
+        squared_errors = knn.squared_errors_sweep(stage['neighbors'], stage['y_tensor'],
+                                                  stage['zbar_tensor'][start:stop], stage['ybar_tensor'][start:stop],
+                                                  stage['k'], stage['weighters'], stage['max_block_bytes'])
+    telemetry.job.count("queries", stop - start)
 
     os.environ.pop("OMP_NUM_THREADS")
 
-    #return torch.mean(sorted_nn_tensor, 0).size()
-    return torch.mean(sorted_nn_tensor, 0)
-
+    return squared_errors.numpy()
 
+def portfolio_losses(z, b, y, epsilon, __lambda):
 
-def setup_fi_cost(x_samples_filepath, y_samples_filepath, generated_data_filepath):
+    # loss of portfolio z[i] with VaR b[i] against each response y[i, j], as Nearest_neighbors_portfolio.loss
+    # (z: queries x num_assets, b: queries, y: queries x num_neighbors x num_assets), or of each of several
+    # portfolios z[i, d] with VaR b[i, d] (z: queries x num_decisions x num_assets, b: queries x num_decisions)
+    if z.dim() == 3:
+        returns = torch.matmul(y, z.transpose(1, 2))
+    else:
+        returns = torch.sum(y * z.unsqueeze(1), 2)
+    b = b.unsqueeze(1)
 
-    ##global random, np, sqrt, floor, ceil, cp, torch, os
-    global cp, np, os, torch
-    ##import random
-    ##from math import sqrt, floor, ceil
-    import cvxpy as cp
-    import numpy as np
-    import os
-    import torch
+    return b + 1/epsilon*torch.clamp(-returns - b, min=0) - __lambda*returns
 
-    global x_tensor, y_tensor, k, lower_diag, epsilon, __lambda
-    #global x_data, y_data, k, lower_diag_np, epsilon, __lambda
+def compute_true_costs(stage_params_filepath, start, stop):
 
-    x_data = np.load(x_samples_filepath)
-    y_data = np.load(y_samples_filepath)
-    #xbar_tensor = torch.from_numpy(x_data)
-    x_tensor = torch.from_numpy(x_data)
-    y_tensor = torch.from_numpy(y_data)
-
-    fi_params = np.load(generated_data_filepath)
+    os.environ["OMP_NUM_THREADS"] = "1"
 
-    k = fi_params['k']
-    lower_diag = torch.from_numpy(fi_params['lower_diag'])
-    #lower_diag_np = fi_params['lower_diag']
-    epsilon = fi_params['epsilon']
-    __lambda = fi_params['__lambda']
+    with telemetry.job.phase("load_stage"):
+        stage = load_stage(stage_params_filepath)
+    epsilon = float(stage['epsilon'])
+    __lambda = float(stage['__lambda'])
+
+    # losses of the portfolios of queries [start, stop) (one or several per query), only against their own neighbors
+    portfolios = stage['portfolios'][start:stop]
+    value_at_risks = stage['value_at_risks'][start:stop]
+    loss_function = lambda block_start, block_stop, nearest_neighbors: \
+        portfolio_losses(portfolios[block_start:block_stop], value_at_risks[block_start:block_stop],
+                         nearest_neighbors, epsilon, __lambda)
+
+    with telemetry.job.phase("expected_losses"):
+        expected_losses_tensor = knn.expected_losses(stage['neighbors'], stage['y_tensor'],
+                                                     stage['zbar_tensor'][start:stop], stage['k'], loss_function,
+                                                     stage['max_block_bytes'], stage['weighter'],
+                                                     portfolios.size(1) if portfolios.dim() == 3 else None)
+    telemetry.job.count("queries", stop - start)
 
-    return 0
+    os.environ.pop("OMP_NUM_THREADS")
 
-def compute_optimal_portfolio(j):
+    return expected_losses_tensor.numpy()
 
-    #import torch
+def compute_optimal_portfolio(stage_params_filepath, j):
 
     os.environ["OMP_NUM_THREADS"] = "1"
 
-    #x_tensor = torch.from_numpy(x_data)
-    #y_tensor = torch.from_numpy(y_data)
-    #lower_diag = torch.from_numpy(lower_diag_np)
-
+    stage = load_stage(stage_params_filepath)
+    y_tensor = stage['y_tensor']
+    epsilon = stage['epsilon']
+    __lambda = stage['__lambda']
 
     # 1. get nearest neighbors
-    xbar = x_tensor[j]
-
-    #sorted_nn_tensor = compute_sorted_nearest_neighbors(global_arrays, xbar)
-
-
-    ### COMPUTE SORTED NEAREST NEIGHBOR
-    Xsub = (x_tensor - xbar).transpose(0, 1)
-
-
-    Z = torch.trtrs(Xsub, lower_diag, upper=False)[0].transpose(0, 1)
-
-    # mahalanobis_distances: mahalanobis distance of each X vector to Xbar
-    mahalanobis_distances = torch.norm(Z, p=2, dim=1)
-
-    ## SORT the data based on distance to xbar
-    mahalanobis_distances_sorted, sorted_indices = torch.sort(mahalanobis_distances, 0)
-
-    Y_sorted = y_tensor[sorted_indices]  # now local scope
-
-    # adjust k to avoid eliminating equi-distant points
-    inclusive_distance_boundary = mahalanobis_distances_sorted[k - 1] + 1e-7
-
-    # cast to int because of weird incompatibility between zero-dim tensor and int in pytorch 0.4.0
-    inclusive_k = int(np.searchsorted(mahalanobis_distances_sorted, inclusive_distance_boundary, side='right'))
-
-    # get indices of nearest neighbors
-    inclusive_k_nearest_neighbor_indices = np.arange(inclusive_k)
-
-    sorted_nn_tensor = Y_sorted[inclusive_k_nearest_neighbor_indices]
-    ### DONE COMPUTE SORTED NEAREST NEIGHBOR
-
-    nearest_neighbors = sorted_nn_tensor.numpy()
-
-    # 2. set up optimization problem
-    loss_len = len(nearest_neighbors)
-    num_assets = y_tensor.size(1)
-    z = cp.Variable(num_assets)
-    L = cp.Variable(loss_len)
-    b = cp.Variable(1)
-
-    # note: just "sum" instead of long sum_entries command appears to work
-
-    obj = cp.Minimize(cp.sum(L)/loss_len)
-
-    # Constraints
-    # long only and unit leverage
-    constrs = [z>=0, sum(z)==1]
-
-    for i in range(loss_len):
-        # this must define the loss function L. Second part obvious
-        # not sure why first part is the same?
-        constrs = constrs + [L[i] >= (1-1/epsilon)*b - (__lambda+1/epsilon)*sum(cp.multiply(nearest_neighbors[i], z))]
-        constrs = constrs + [L[i] >= b - __lambda*sum(cp.multiply(nearest_neighbors[i, :], z))]
-
-    # find optimal z, VaR (b) -- which minimizes total cost
-    # this minimum total cost (over hitorical points) is problem.optval
-    problem=cp.Problem(obj, constrs)
-
-
-    # 3. now, optimize
-    problem.solve(solver=cp.ECOS)
+    zbar = stage['zbar_tensor'][j]
+
+    with telemetry.job.phase("neighbor_search"):
+        neighbor_indices = knn.nearest_neighbor_indices(stage['neighbors'], zbar, stage['k'])
+    telemetry.job.count("queries")
+    telemetry.job.count("neighbors", len(neighbor_indices))
+
+    # 2. the LP only depends on the neighbor set, epsilon and lambda: reuse the solution of any earlier query
+    # (of any stage, if the responses are dataset rows) which had the same one
+    neighbor_rows = stage['y_rows'][neighbor_indices.numpy()]
+    with telemetry.job.phase("solution_cache"):
+        key = cvar_lp.Solution_cache.fingerprint(neighbor_rows, epsilon, __lambda, stage['y_source'],
+                                                 stage['lp_solver'])
+        optimal_portfolio = cvar_lp.solution_cache.get(key)
+    cache_hit = optimal_portfolio is not None
+    telemetry.job.count("cache_hits", int(cache_hit))
+
+    # 3. solve the CVaR problem: compiled once per neighbor count on this worker (ecos), assembled as a sparse
+    # LP and handed to HiGHS directly (highs), or updated from the previous query's HiGHS model, scenarios being
+    # matched by neighbor row (highs_warm) -- see cvar_lp.py
+    if not cache_hit:
+        nearest_neighbors = y_tensor[neighbor_indices].numpy()
+        with tracing.tracer.span("solve_lp", query=j, num_neighbors=len(nearest_neighbors)):
+            optimal_portfolio = cvar_lp.solve(nearest_neighbors, epsilon, __lambda, stage['lp_solver'], neighbor_rows)
+        cvar_lp.solution_cache.put(key, optimal_portfolio)
+        telemetry.job.count("lp_solves")
 
     os.environ.pop("OMP_NUM_THREADS")
 
-    #print (problem.value, z.value, b.value, problem.status)
-    #'''
-    #return (0,1,2)
-    return (problem.value, z.value, b.value, problem.status)
+    return optimal_portfolio, cache_hit
+
+def compute_optimal_portfolios(stage_params_filepath, start, stop):
+
+    # chunk of queries [start, stop); results come back packed as arrays rather than one tuple per query
+    with telemetry.job.phase("load_stage"):
+        stage = load_stage(stage_params_filepath)
+    num_assets = stage['y_tensor'].size(1)
+
+    # positions of the chunk are walked in locality order when the driver provided one, so consecutive queries
+    # have mostly the same neighbors: the highs_warm solver then only updates the scenarios which changed, and
+    # restarts from the previous basis (neighbor rows only have a meaning within the stage: start afresh)
+    cvar_lp.reset_warm_start()
+    query_order = stage['query_order']
+    queries = range(start, stop) if query_order is None else query_order[start:stop]
+
+    costs = np.empty(stop - start)
+    z = np.empty((stop - start, num_assets))
+    b = np.empty(stop - start)
+    status = []
+    cache_hits = np.zeros(stop - start, dtype=bool)
+    for idx, j in enumerate(queries):
+        optimal_portfolio, cache_hits[idx] = compute_optimal_portfolio(stage_params_filepath, int(j))
+        costs[idx], z_value, b_value, problem_status = optimal_portfolio
+        z[idx] = z_value
+        # b is a 1-element variable
+        b[idx] = np.asarray(b_value).reshape(-1)[0]
+        status.append(problem_status)
+
+    return costs, z, b, np.array(status), cache_hits
 
 class Nearest_neighbors_portfolio:
 
-    def __init__(self, name, compute_nodes, compute_nodes_pythonic, epsilon, __lambda, output_dir, x_samples_filename, y_samples_filename, sanity=False, short=False, profile=False):
+    def __init__(self, name, compute_nodes, compute_nodes_pythonic, epsilon, __lambda, output_dir, x_samples_filename,
+                 y_samples_filename, sanity=False, short=False, profile=False, neighbor_backend="brute", session=None,
+                 lp_solver="ecos", max_block_bytes=knn.DEFAULT_BLOCK_BYTES, smoother_names=None, num_bandwidths=10,
+                 mmap=False):
         self.name = name
         self.compute_nodes = compute_nodes
         self.compute_nodes_pythonic = compute_nodes_pythonic
@@ -227,6 +285,23 @@ class Nearest_neighbors_portfolio:
         self.sanity = sanity
         self.short = short
         self.profile = profile
+        # nearest neighbor search: "brute" (exhaustive, blocked) or "kd_tree"
+        self.neighbor_backend = neighbor_backend
+        # CVaR LP solver: "ecos" (through cvxpy), "highs" (direct sparse LP) or "highs_warm" (HiGHS model updated
+        # from query to query)
+        self.lp_solver = lp_solver
+        # memory budget of one block of queries of a nearest neighbor pass, on each worker
+        self.max_block_bytes = max_block_bytes
+        # smoothers considered by the hyperparameter search (naive only by default), and size of the bandwidth
+        # grid of non-naive ones
+        if smoother_names is None:
+            smoother_names = ["Naive"]
+        self.smoother_list = [smoother.Smoother(name) for name in smoother_names]
+        self.num_bandwidths = num_bandwidths
+        # memory-map the dataset read-only instead of reading a private copy
+        self.mmap = mmap
+        # persistent compute session (see compute_session.py) -- owned by the simulator
+        self.session = session
 
         self.configure_logger()
 
@@ -244,9 +319,10 @@ class Nearest_neighbors_portfolio:
         self.ch = logging.StreamHandler()
         self.ch.setLevel(logging.INFO)
         # create formatter and add it to the handlers
-        # just a placeholder -- will be updated on the fly by timed decorator
-        formatter = logging.Formatter('    %(name)s - %(levelname)s: - %(message)s')
+        # lines are indented by the nesting of the current span (see tracing.Indent_filter)
+        formatter = logging.Formatter('%(indent)s%(name)s - %(levelname)s: - %(message)s')
         self.ch.setFormatter(formatter)
+        self.ch.addFilter(tracing.indent_filter)
         # add the handlers to the logger
         self.logger.addHandler(self.ch)
 
@@ -262,10 +338,12 @@ class Nearest_neighbors_portfolio:
         if self.sanity or self.short:
 
             # train on first num_samples_in_dataset samples; note: each row is a sample!
+            self.tr_indices = np.arange(self.num_samples)
             self.X_tr = self.X_data[0:self.num_samples]
             self.Y_tr = self.Y_data[0:self.num_samples]
 
             # all the non-training data is considered "validation" data -- but this is actually out of sample data! almost all the data is out of sample
+            self.val_indices = np.arange(self.num_samples, len(self.X_data))
             self.X_val = self.X_data[self.num_samples:]
             self.Y_val = self.Y_data[self.num_samples:]
 
@@ -273,126 +351,134 @@ class Nearest_neighbors_portfolio:
         
             # Training data
             train_perm = sorted(random.sample(range(len(self.X_data)), self.num_samples))
+            self.tr_indices = np.asarray(train_perm)
             self.X_tr = self.X_data[train_perm]
             self.Y_tr = self.Y_data[train_perm]
 
             # Validation data
             val_perm = sorted(list(set(range(len(self.X_data))) - set(train_perm)))
+            self.val_indices = np.asarray(val_perm)
             self.X_val = self.X_data[val_perm]
             self.Y_val = self.Y_data[val_perm]
 
-    @timed
-    def compute_full_information_hyperparameters(self):
+    def set_nested_split(self, nested_training_sets, max_num_samples):
 
-        self.hyperparameters_fi = self.compute_hyperparameters(self.Y_data, self.X_data)
+        # training set: prefix of size num_samples of the nested ordering; validation set: the rest of the ordering
+        # after the largest training set, the same for every size
+        self.tr_indices = nested_training_sets.training_indices(self.num_samples)
+        self.X_tr = self.X_data[self.tr_indices]
+        self.Y_tr = self.Y_data[self.tr_indices]
 
+        self.val_indices = nested_training_sets.validation_indices(max_num_samples)
+        self.X_val = self.X_data[self.val_indices]
+        self.Y_val = self.Y_data[self.val_indices]
 
-    # can find analytically?
     @timed
-    def compute_full_information_oos_cost(self):
+    def compute_learning_curve(self, num_samples_list, num_iterations):
+
+        """
+        Arguments:
 
-        # see compute_expected_responses for explanation of this hack
-        #global compute_full_information_oos_cost_globals
-        #compute_full_information_oos_cost_globals = type('test', (), {})()
-        #compute_full_information_oos_cost_globals = Compute_full_information_oos_cost_vars(torch.from_numpy(self.X_data), torch.from_numpy(self.X_data), torch.from_numpy(self.Y_data), self.hyperparameters_fi, self.epsilon, self.__lambda)
-        #compute_full_information_oos_cost_globals.__module__ = '__main__'
-        #compute_full_information_oos_cost_globals.Xbar_tensor = torch.from_numpy(self.X_data)
-        #compute_full_information_oos_cost_globals.X_tensor = torch.from_numpy(self.X_data)
-        #compute_full_information_oos_cost_globals.Y_tensor = torch.from_numpy(self.Y_data)
-        #compute_full_information_oos_cost_globals.hyperparameters_object = self.hyperparameters_fi
-        #compute_full_information_oos_cost_globals.epsilon = self.epsilon
-        #compute_full_information_oos_cost_globals.__lambda = self.__lambda
-        generated_data_filepath = self.output_dir + "/autogen/full_information_params.npz"
-        np.savez(generated_data_filepath, k=self.hyperparameters_fi.k, lower_diag=self.hyperparameters_fi.upper_diag.transpose(0, 1),
-                 epsilon=self.epsilon, __lambda=self.__lambda)
-
-        #num_cores = int(available_cpu_count())
-        #print(num_cores)
-        #os.environ["OMP_NUM_THREADS"] = "1"
-
-        '''
-        pool = ThreadPool(num_cores)
-        args_iterable = zip(itertools.repeat("compute_full_information_oos_cost_globals"), range(len(self.X_data)))
-        optimal_portfolio_list = pool.starmap(Nearest_neighbors_portfolio.compute_optimal_portfolio,args_iterable,10)
-        '''
-
-        '''
-        from pathos.pp import ParallelPythonPool as Pool
-        ppservers = ("nia0859.scinet.local:1234",)
-        pool = Pool(num_cores*2, servers=ppservers)
-
-
-        #optimal_portfolio_list = pool.starmap(Nearest_neighbors_portfolio.compute_optimal_portfolio,
-        #                zip(itertools.repeat("compute_full_information_oos_cost_globals"), range(len(self.X_data))),
-        #                                      1000)
-
-        #optimal_portfolio_list = pool.starmap(Nearest_neighbors_portfolio.compute_optimal_portfolio,
-        #                zip(itertools.repeat("compute_full_information_oos_cost_globals"), range(len(self.X_data))))
-
-
-        #args_iterable = zip(itertools.repeat("compute_full_information_oos_cost_globals"), range(len(self.X_data)))
-        #optimal_portfolio_list = pool.starmap(Nearest_neighbors_portfolio.compute_optimal_portfolio,args_iterable)
-
-
-        args_iterable = zip(itertools.repeat("compute_full_information_oos_cost_globals"), range(len(self.X_data)))
-        optimal_portfolio_results_object = pool.amap(Nearest_neighbors_portfolio.compute_optimal_portfolio, *map(list, zip(*args_iterable)) )
-        optimal_portfolio_list = optimal_portfolio_results_object.get()
-        '''
-        #pkl_filename = 'compute_full_information_oos_cost_globals.pkl'
-        #with open(pkl_filename, 'wb') as handle:
-        #    pkl.dump(compute_full_information_oos_cost_globals, handle)
-
-        x_samples_filepath = ME_DIR + '/' + self.x_samples_filename
-        y_samples_filepath = ME_DIR + '/' + self.y_samples_filename
-
-        # change working directory temporarily to force JobCluster command to dump in the proper output directory
-        original_working_dir = os.getcwd()
-        os.chdir(self.output_dir + '/' + 'dispy')
-
-        # tell dispy where all the compute nodes are and set them up using setup command
-        cluster = dispy.JobCluster(compute_optimal_portfolio, nodes=self.compute_nodes_pythonic, setup=functools.partial(setup_fi_cost, x_samples_filepath, y_samples_filepath, generated_data_filepath))
-        #cluster = dispy.JobCluster(compute_optimal_portfolio, nodes=["nia1189.scinet.local", ], setup=setup)
-
-        # return to original working dir to avoid any unintended effects from dir change
-        os.chdir(original_working_dir)
-
-        jobs = []
-        for i in range(len(self.X_data)):
-        #for i in range(10):
-            self.i = i
-            job = cluster.submit(i) # it is sent to a node for executing 'compute'
-            job.id = i # store this object for later use
-            jobs.append(job)
+            num_samples_list: training set sizes of the learning curve
+            num_iterations: number of independent draws of nested training sets
 
-        full_information_oos_costs = np.empty(len(self.X_data))
-        for idx, job in enumerate(jobs):
-            job() # wait for job to finish
-            full_information_oos_costs[idx] = job.result[0]
+        Returns:
+
+            tr_oos_costs: training model oos cost for each size, one per iteration ({num_samples: [cost, ...]})
+
+        Description:
+
+            Each iteration draws one ordering of the dataset and walks the sizes in increasing order, so each
+            training set extends the previous one (see learning_curve.Nested_training_sets). What carries over
+            from one size to the next:
+
+                -- the covariance of the training set, updated from the added samples only
+                -- the validation set: the samples after the largest training set, so every size is scored on
+                   the same contexts
+                -- the true cost: the portfolios of all sizes are evaluated together, in one full information
+                   nearest neighbor pass over the validation contexts
+                -- LP solutions, through the solution cache: a validation context whose training neighbors did
+                   not change with the added samples is not re-solved
+
+            The hyperparameter search and the training model LPs still run once per size, since the metric and
+            the neighbors follow the covariance of each training set; with geometrically spaced sizes the largest
+            size still accounts for most of their total.
+        """
+        tr_oos_costs = {num_samples: [] for num_samples in num_samples_list}
+        sorted_num_samples = sorted(num_samples_list)
 
-        cluster.close()
+        for i in range(num_iterations):
 
-        # relaunch dispynodes because of this bug: https://github.com/pgiri/dispy/issues/143
-        #cmd_str = 'launch_remote_dispynodes.sh ' + self.output_dir + ' ' + ' '.join(self.compute_nodes)
-        #os.system(cmd_str)
-        #time.sleep(3)
+            nested_training_sets = learning_curve.Nested_training_sets(len(self.X_data),
+                                                                       deterministic=self.sanity or self.short)
+            running_covariance = learning_curve.Running_covariance(self.X_data.shape[1])
 
+            portfolios = None
+            for s, num_samples in enumerate(sorted_num_samples):
 
-        '''
-        pool.close()
-        pool.join()
-        '''
-        #os.environ.pop("OMP_NUM_THREADS")
+                self.set_num_samples(num_samples)
+                self.set_nested_split(nested_training_sets, sorted_num_samples[-1])
 
+                # only the samples added since the previous size enter the covariance update
+                running_covariance.extend(self.X_tr[running_covariance.count:])
+
+                logging.info("Getting hyperparameters for training NN model on " + str(num_samples) + " samples...")
+                self.hyperparameters_tr = self.compute_hyperparameters(self.Y_tr, self.X_tr, indices=self.tr_indices,
+                                                                       covariance=running_covariance.covariance(),
+                                                                       split=nested_training_sets.inner_split(num_samples))
+
+                if portfolios is None:
+                    portfolios = np.empty((len(self.X_val), len(sorted_num_samples), self.Y_data.shape[1]))
+                    value_at_risks = np.empty((len(self.X_val), len(sorted_num_samples)))
+                portfolios[:, s] = self.compute_training_model_portfolios()
+                value_at_risks[:, s] = value_at_risk.value_at_risk_batch(self.X_val, portfolios[:, s], self.epsilon)
+
+            # one true cost stage for every size of the iteration
+            true_costs = self.compute_true_oos_costs(portfolios, value_at_risks)
+            for s, num_samples in enumerate(sorted_num_samples):
+                tr_oos_costs[num_samples].append(np.mean(true_costs[:, s]))
+
+        return tr_oos_costs
+
+    @timed
+    def compute_full_information_hyperparameters(self):
 
-        # extract only costs from list of portfolio problem tuples (cost is first element of every tuple
-        # see https://stackoverflow.com/a/31297256/8112889
-        #full_information_oos_costs_list = list(zip(*optimal_portfolio_list))[0]
+        self.hyperparameters_fi = self.compute_hyperparameters(self.Y_data, self.X_data,
+                                                               indices=np.arange(len(self.X_data)))
 
-        # convert costs list to torch tensor
-        #full_information_oos_costs = torch.stack(full_information_oos_costs_list)
-        #full_information_oos_costs = np.array(full_information_oos_costs_list)
 
-        #return torch.mean(full_information_oos_costs)
+    # can find analytically?
+    @timed
+    def compute_full_information_oos_cost(self):
+
+        # the full dataset is resident on the workers: every sample is both a neighbor and a context of interest
+        all_indices = np.arange(len(self.X_data))
+        query_order = self.locality_order(self.X_data, self.hyperparameters_fi)
+        stage_params_filepath = self.session.write_stage_params("full_information_params", k=self.hyperparameters_fi.k,
+                                                                lower_diag=self.hyperparameters_fi.upper_diag.transpose(0, 1),
+                                                                epsilon=self.epsilon, __lambda=self.__lambda,
+                                                                neighbor_backend=self.neighbor_backend,
+                                                                lp_solver=self.lp_solver,
+                                                                max_block_bytes=self.max_block_bytes,
+                                                                x_indices=all_indices, y_indices=all_indices,
+                                                                xbar_indices=all_indices, query_order=query_order)
+
+        # chunks hold consecutive positions of the locality order; costs are put back in sample order as chunks
+        # complete, and their running mean and variance kept up to date
+        full_information_oos_costs = np.empty(len(self.X_data))
+        cost_moments = compute_session.Running_moments()
+        cache_hits = [0]
+        def consume(start, stop, chunk):
+            costs, z, b, status, chunk_cache_hits = chunk
+            full_information_oos_costs[query_order[start:stop]] = costs
+            cost_moments.update(costs)
+            cache_hits[0] += int(np.sum(chunk_cache_hits))
+
+        # chunks of samples, on workers which already hold the dataset
+        self.session.run_chunks("compute_optimal_portfolios", stage_params_filepath, len(self.X_data), consume)
+        self.logger.info("Full information oos cost: " + str(cost_moments))
+        self.log_solution_cache_hits(cache_hits[0], len(self.X_data))
+
         return np.mean(full_information_oos_costs)
         
 
@@ -404,58 +490,89 @@ class Nearest_neighbors_portfolio:
         #         -- from which we get weighter based on heuristically chosen bandwidth and smoother)
         #     -- learn the number of nearest neighbours
         logging.info("Getting hyperparameters for training NN model...")
-        self.hyperparameters_tr = self.compute_hyperparameters(self.Y_tr, self.X_tr)
+        self.hyperparameters_tr = self.compute_hyperparameters(self.Y_tr, self.X_tr, indices=self.tr_indices)
 
 
     @timed
     def compute_training_model_oos_cost(self):
 
-        # see compute_expected_responses for explanation of this hack
-        global compute_training_model_oos_cost_globals
-        compute_training_model_oos_cost_globals = type('', (), {})()
-        compute_training_model_oos_cost_globals.Xbar_tensor = torch.from_numpy(self.X_val)
-        compute_training_model_oos_cost_globals.X_tensor = torch.from_numpy(self.X_tr)
-        compute_training_model_oos_cost_globals.Y_tensor = torch.from_numpy(self.Y_tr)
-        compute_training_model_oos_cost_globals.hyperparameters_object = self.hyperparameters_tr
-        compute_training_model_oos_cost_globals.epsilon = self.epsilon
-        compute_training_model_oos_cost_globals.__lambda = self.__lambda
+        portfolios = self.compute_training_model_portfolios()
 
-        num_cores = int(available_cpu_count())
-        os.environ["OMP_NUM_THREADS"] = "1"
-        pool = ThreadPool(num_cores)
-        optimal_portfolio_list = pool.starmap(Nearest_neighbors_portfolio.compute_optimal_portfolio,
-                        zip(itertools.repeat("compute_training_model_oos_cost_globals"), range(len(self.X_val))))
+        # find b (VaR) analytically, for every validation context at once
+        value_at_risks = value_at_risk.value_at_risk_batch(self.X_val, portfolios, self.epsilon)
 
+        return np.mean(self.compute_true_oos_costs(portfolios, value_at_risks))
 
-        # extract only costs from list of portfolio problem tuples (cost is first element of every tuple
-        # see https://stackoverflow.com/a/31297256/8112889
-        #####training_oos_costs_list = list(zip(*optimal_portfolio_list))[0]
+    def compute_training_model_portfolios(self):
 
-        # convert costs list to torch tensor
-        #full_information_oos_costs = torch.stack(full_information_oos_costs_list)
-        #####training_oos_costs = np.array(training_oos_costs_list)
+        # optimal portfolio of every validation context, using its nearest neighbors among the training samples;
+        # both are rows of the dataset resident on the workers
+        query_order = self.locality_order(self.X_val, self.hyperparameters_tr)
+        stage_params_filepath = self.session.write_stage_params("training_model_params", k=self.hyperparameters_tr.k,
+                                                                lower_diag=self.hyperparameters_tr.upper_diag.transpose(0, 1),
+                                                                epsilon=self.epsilon, __lambda=self.__lambda,
+                                                                neighbor_backend=self.neighbor_backend,
+                                                                lp_solver=self.lp_solver,
+                                                                max_block_bytes=self.max_block_bytes,
+                                                                x_indices=self.tr_indices, y_indices=self.tr_indices,
+                                                                xbar_indices=self.val_indices, query_order=query_order)
 
-        pool.close()
-        pool.join()
-        os.environ.pop("OMP_NUM_THREADS")
+        # chunks hold consecutive positions of the locality order; put the portfolios back in validation order
+        portfolios = np.empty((len(self.X_val), self.Y_data.shape[1]))
+        cache_hits = [0]
+        def consume(start, stop, chunk):
+            costs, z, b, status, chunk_cache_hits = chunk
+            portfolios[query_order[start:stop]] = z
+            cache_hits[0] += int(np.sum(chunk_cache_hits))
 
-        tr_learner_oos_cost_true=0
-        for idx, optimal_portfolio in enumerate(optimal_portfolio_list):
+        self.session.run_chunks("compute_optimal_portfolios", stage_params_filepath, len(self.X_val), consume)
+        self.log_solution_cache_hits(cache_hits[0], len(self.X_val))
 
-            c_tr, z_tr, b_tr, s_tr = optimal_portfolio
-            x_val = self.X_val[idx]
+        return portfolios
 
-            # find b (VaR) analytically
-            b=value_at_risk.value_at_risk(x_val, z_tr, self.epsilon)
+    def compute_true_oos_costs(self, portfolios, value_at_risks):
 
-            # find true Y|X (returns Y distribution with weights)
-            training_loss_fnc = lambda y: self.loss(z_tr, b, y)
-            training_loss = np.apply_along_axis(training_loss_fnc, 1, self.Y_data)
-            c_tr_true = self.compute_expected_responses(training_loss, self.X_data, x_val, self.hyperparameters_fi)
+        """
+        Arguments:
 
-            tr_learner_oos_cost_true += c_tr_true
+            portfolios: portfolio of each validation context (num_val x num_assets), or several portfolios of each
+                        (num_val x num_decisions x num_assets, eg one per training set size of a learning curve)
+            value_at_risks: VaR of each portfolio (num_val, or num_val x num_decisions)
 
-        return tr_learner_oos_cost_true/len(self.X_val)
+        Returns:
+
+            true_costs: expected loss of each portfolio under the full information model (shaped as value_at_risks)
+
+        Description:
+
+            find true Y|X: expected loss of each validation portfolio under the full information model, ie its
+            mean loss over the full information nearest neighbors of its context -- one nearest neighbor pass for
+            all validation contexts (and all their portfolios), losses only evaluated against the neighbors, in
+            memory-bounded blocks
+        """
+        all_indices = np.arange(len(self.X_data))
+        stage_params_filepath = self.session.write_stage_params("training_model_true_cost_params",
+                                                                k=self.hyperparameters_fi.k,
+                                                                lower_diag=self.hyperparameters_fi.upper_diag.transpose(0, 1),
+                                                                smoother=str(self.hyperparameters_fi.smoother),
+                                                                bandwidth=self.hyperparameters_fi.bandwidth,
+                                                                epsilon=self.epsilon, __lambda=self.__lambda,
+                                                                neighbor_backend=self.neighbor_backend,
+                                                                max_block_bytes=self.max_block_bytes,
+                                                                x_indices=all_indices, y_indices=all_indices,
+                                                                xbar_indices=self.val_indices,
+                                                                portfolios=portfolios, value_at_risks=value_at_risks)
+
+        tr_learner_oos_costs_true = np.empty(np.shape(value_at_risks))
+        cost_moments = compute_session.Running_moments()
+        def consume(start, stop, costs):
+            tr_learner_oos_costs_true[start:stop] = costs
+            cost_moments.update(costs)
+
+        self.session.run_chunks("compute_true_costs", stage_params_filepath, len(self.X_val), consume)
+        self.logger.info("Training model true oos cost: " + str(cost_moments))
+
+        return tr_learner_oos_costs_true
 
 
     @timed
@@ -463,8 +580,9 @@ class Nearest_neighbors_portfolio:
 
         #self.X_data = np.loadtxt(x_csv_filename, delimiter=",")
         #self.Y_data = np.loadtxt(y_csv_filename, delimiter=",")
-        self.X_data = np.load(self.x_samples_filename)
-        self.Y_data = np.load(self.y_samples_filename)
+        mmap_mode = 'r' if self.mmap else None
+        self.X_data = np.load(self.x_samples_filename, mmap_mode=mmap_mode)
+        self.Y_data = np.load(self.y_samples_filename, mmap_mode=mmap_mode)
 
 
 
@@ -473,6 +591,29 @@ class Nearest_neighbors_portfolio:
     
         return b + 1/self.epsilon*max(-np.dot(z, y)-b, 0)-self.__lambda*np.dot(z, y)
 
+    def log_solution_cache_hits(self, cache_hits, num_queries):
+
+        # number of queries whose LP solution was reused (see cvar_lp.Solution_cache)
+        self.logger.info("LP solution cache: " + str(cache_hits) + " hits, " + str(num_queries - cache_hits) +
+                         " misses (hit rate " + "{:.1%}".format(cache_hits / num_queries if num_queries else 0) + ")")
+
+    def locality_order(self, xbar, hyperparameters_object):
+
+        # contexts of interest ordered along a Morton curve in whitened coordinates, where distances are those of
+        # the nearest neighbor search: contiguous chunks then hold nearby contexts, whose neighbors (and LPs) are
+        # mostly the same
+        lower_diag = hyperparameters_object.upper_diag.transpose(0, 1)
+        zbar_tensor = knn.whiten(shared_tensor(xbar.reshape(len(xbar), -1)), lower_diag)
+
+        return scheduling.morton_order(zbar_tensor.numpy())
+
+    def dataset_reference(self, name, array, indices):
+
+        # rows of the dataset resident on the workers are shipped as indices, anything else as the array itself
+        if indices is not None:
+            return {name + '_indices': np.asarray(indices)}
+        return {name: array}
+
     '''
 #    @timed
     def mahalanobis(self, x1, x2, A):
@@ -489,7 +630,11 @@ class Nearest_neighbors_portfolio:
     '''
 
     @timed
-    def compute_hyperparameters(self, Y, X, p=0.2, smoother_list=[smoother.Smoother("Naive")]):
+    def compute_hyperparameters(self, Y, X, p=0.2, smoother_list=None, indices=None, covariance=None, split=None):
+
+        # smoothers to consider, naive only unless configured otherwise
+        if smoother_list is None:
+            smoother_list = self.smoother_list
 
         # num rows X -- ie num samples
         num_samples_in_dataset = np.size(X, 0)
@@ -510,52 +655,72 @@ class Nearest_neighbors_portfolio:
 
         # Compute covariance of covariates
         # TODO: check the math, why identity -- is this really mahalanobis?
-        epsilonX = np.cov(X.T, bias=True) + np.identity(num_covariates)/num_samples_in_dataset
+        # (the learning curve keeps a running covariance of its nested training sets, see learning_curve.py)
+        if covariance is None:
+            covariance = np.cov(X.T, bias=True)
+        epsilonX = covariance + np.identity(num_covariates)/num_samples_in_dataset
 
         upper_diag = torch.from_numpy(epsilonX)
         torch.potrf(upper_diag, out=upper_diag)
 
         # hyperparameters
 
-        # TODO: add this unused julia code for NW portfolio?
-        #D = [d(X[i, :], mean_X) for i in range(0,num_samples_in_dataset)]
-
         k_list = np.unique(np.round(np.linspace(max(1, floor(sqrt(num_samples_in_dataset)/1.5)), min(ceil(sqrt(num_samples_in_dataset)*1.5), num_samples_in_dataset), 20).astype('int')))
 
-        # pick 20% of the original (training) samples as your validation set -- note: sorting not necessary
-        if self.sanity or self.short:
-            val = range(round(num_samples_in_dataset*p))
+        if split is not None:
+
+            # (train, val) positions given by the caller, eg nested along a learning curve
+            train, val = split
+
         else:
-            val = sorted(random.sample(range(num_samples_in_dataset), round(num_samples_in_dataset*p)))
 
-        # the remaining 80% is your new "training" set
-        train = sorted(list(set(range(num_samples_in_dataset)) - set(val)))
+            # pick 20% of the original (training) samples as your validation set -- note: sorting not necessary
+            if self.sanity or self.short:
+                val = range(round(num_samples_in_dataset*p))
+            else:
+                val = sorted(random.sample(range(num_samples_in_dataset), round(num_samples_in_dataset*p)))
+
+            # the remaining 80% is your new "training" set
+            train = sorted(list(set(range(num_samples_in_dataset)) - set(val)))
+
+        # rows of X and Y within the dataset resident on the workers, if they come from it
+        train_indices = None if indices is None else np.asarray(indices)[train]
+        val_indices = None if indices is None else np.asarray(indices)[val]
 
         logging.debug("Number of k to test: " + str(len(k_list)))
 
+        # bandwidths of the non-naive smoothers: log-spaced between the smallest and largest distance of a
+        # training sample to their mean (D in the julia code), in the whitened coordinates the distances live in
+        bandwidth_list = [1]
+        if any(test_smoother != "Naive" for test_smoother in smoother_list):
+            z_train = knn.whiten(torch.from_numpy(np.ascontiguousarray(X[train])), upper_diag.transpose(0, 1))
+            D = torch.sqrt(torch.sum((z_train - torch.mean(z_train, 0)) ** 2, 1)).numpy()
+            D = D[D > 0] if np.any(D > 0) else np.ones(1)
+            bandwidth_list = np.logspace(np.log10(np.min(D)), np.log10(np.max(D)), self.num_bandwidths)
+
+        # every (smoother, bandwidth) pair of the search, in the order they are compared below
+        sweep = [(test_smoother, bandwidth) for test_smoother in smoother_list
+                 for bandwidth in ([1] if test_smoother == "Naive" else bandwidth_list)]
+        sweep_index = {(str(test_smoother), bandwidth): index for index, (test_smoother, bandwidth) in enumerate(sweep)}
+
+        # sum distance of all E[Y|xbar] to true Y for all X in validation set and every (smoother, bandwidth, k),
+        # from a single nearest neighbor pass
+        squared_errors = self.compute_squared_errors_sweep(Y[train], X[train], X[val], Y[val], upper_diag, k_list,
+                                                           sweep, train_indices, val_indices)
+
         shortest_distance = -1
         for test_smoother in smoother_list:
-            for test_k in k_list:
-
-                # TODO: add this unused julia code for NW portfolio?
-                #bandwidth_list = logspace(log10(minimum(D)), log10(maximum(D)), 10)
-                if test_smoother == "Naive":
-                    bandwidth_list = [1]
+            for k_index, test_k in enumerate(k_list):
 
-                for bandwidth in bandwidth_list:
+                for bandwidth in ([1] if test_smoother == "Naive" else bandwidth_list):
 
                     test_hyperparameters = hyperparameters.Hyperparameters(test_k, test_smoother, upper_diag, bandwidth)
 
                     logging.debug("Smoother function : " + str(test_hyperparameters))
                     logging.debug("Number of neighbors : k = " + str(test_k))
 
-                    
-                    # find E[Y|xbar] for all X in validation set
-                    expected_responses = self.compute_expected_responses(Y[train], X[train], X[val],
-                                                                         test_hyperparameters)
-
                     # sum distance of all these E[Y|xbar] to true Y (respectively)
-                    model_distance = np.sum((Y[val]-expected_responses)**2)
+                    model_distance = squared_errors[sweep_index[(str(test_smoother), bandwidth)], k_index]
 
                     # the shortest such distance corresponds to most accurate model, ie 
                     # this model has best hyperparameters, so we store them
@@ -567,273 +732,51 @@ class Nearest_neighbors_portfolio:
 
 
     @timed
-    @profile
-    def compute_expected_responses(self, Y, X, Xbar, hyperparameters_object):
+    def compute_squared_errors_sweep(self, Y, X, Xbar, Ybar, upper_diag, k_list, sweep, x_indices=None,
+                                     xbar_indices=None):
 
         """
         Arguments:
 
             Y: historical 'response' variable (typically asset returns)
             X: historical covariates
-            Xbar: observation ("today's" covariate) -- can be interpreted as X context of interest
-            hyperparameters_object: number of nearest neighbors k, smoother function, upper_diagonal, bandwidth
-              -- uuper diagonal is Cholesky factor of mahalanobis matrix
+            Xbar: observations ("today's" covariates) -- contexts of interest, one per row
+            Ybar: true responses of the contexts of interest (Y of xbar_indices)
+            upper_diag: Cholesky factor of mahalanobis matrix
+            k_list: numbers of nearest neighbors to evaluate
+            sweep: (smoother, bandwidth) pairs to evaluate
+            x_indices, xbar_indices: rows of X (and Y), Xbar (and Ybar) within the dataset resident on the workers
 
         Returns:
 
-            expected_response: expected response given Xbar observation/context
-
+            squared_errors: sum over the contexts of interest of the squared distance between the true and the
+                            expected response, for each pair of sweep and each k (len(sweep) x len(k_list))
 
         Description:
 
-            1. Find the k nearest neighbors of Xbar inside X, using mahalanobis distance
-            2. Adjust k so that points just outside k-set which have equal distance as kth point are included
-               -- call this adjusted k, "inclusive_k"
-            3. Assign weights based on mahalanobis distance, a bandwidth, and a smoothing function
-               -- Points further from xbar generally have smaller weights (naive smoother has equal weights)
-               -- Smoother transforms distance to weights (eg for gaussian smoother, zero distance is center
-                  of gaussian curve and further distances fall with distance from center)
-               -- Higher bandwidth reduces distance as seen by smoothing function
-                  -- depending on smoother this could have different effects (for example, for squaref uniform,
-                     will give zero weight to fewer points)
-
+            Sorted neighbor distances are computed once per context and every (smoother, bandwidth, k) is scored
+            on them (see knn.squared_errors_sweep). Workers send back their partial sums only.
         """
-        num_samples_in_dataset = np.size(Y, 0)
-
-        if Y.ndim == 2:
-          num_assets = np.size(Y, 1)
-        else: # Y.ndim ==1
-          num_assets = 1
-
-        num_covariates = np.size(X,1)
-
-        if Xbar.ndim == 2:
-            num_observations = np.size(Xbar, 0)
-        else: # Xbar.dim == 1
-            num_observations = 1
-
-        # creating a global class is a hack workaround until pathos.multiprocessing supports
-        # passing local large arrays: https://github.com/uqfoundation/pathos/issues/145
-        # TODO: update if/when pathos adds local array support
-        # This will require passing these arrays as arguments to starmap (will need to check if that works)
-        # or making compute_expected_response nested (this is know to work but very slow until pathos fixes)
-        # probably better still would be to make it a closure if that works: https://www.learnpython.org/en/Closures
-        #   -- it will be defined elsewhere, with only the arrays being passed in and the function is generated with
-        # only the j argument. -- will need to check if the resulting function truly creates shared arrays
-        # and doesn't clone
-
-        #global compute_expected_responses_globals
-        #compute_expected_responses_globals = type('', (), {})() # see https://stackoverflow.com/a/19476841/8112889
-        #compute_expected_responses_globals.Xbar_tensor = torch.from_numpy(Xbar).view(num_observations, -1)
-        #compute_expected_responses_globals.X_tensor = torch.from_numpy(X)
-        #compute_expected_responses_globals.Y_tensor = torch.from_numpy(Y)
-        #compute_expected_responses_globals.hyperparameters_object = hyperparameters_object
-
-        #'''
-        generated_data_filepath = self.output_dir + '/autogen/compute_expected_responses_params.npz'
-        np.savez(generated_data_filepath, k=hyperparameters_object.k, lower_diag=hyperparameters_object.upper_diag.transpose(0, 1),
-                 x=X, y=Y, xbar=Xbar.reshape(num_observations,-1))
-
-        # change working directory temporarily to force JobCluster command to dump in the proper output directory
-        original_working_dir = os.getcwd()
-        os.chdir(self.output_dir + '/' + 'dispy')
-
-        # tell dispy where all the compute nodes are and set them up using setup command
-        cluster = dispy.JobCluster(compute_expected_response, nodes=self.compute_nodes_pythonic, setup=functools.partial(setup_expected_responses, generated_data_filepath))
-        #cluster = dispy.JobCluster(compute_optimal_portfolio, nodes=["nia1189.scinet.local", ], setup=setup)
-
-        # return to original working dir to avoid any unintended effects from dir change
-        os.chdir(original_working_dir)
-
-        jobs = []
-
-        for i in range(num_observations):
-        #for i in range(10):
-            #self.i = i
-            job = cluster.submit(i) # it is sent to a node for executing 'compute'
-            #job.id = i # store this object for later use
-            jobs.append(job)
-
-        #expected_responses_list = np.empty(len(self.Xbar))
-        expected_responses_list = torch.empty(num_observations, num_assets)
-        for idx, job in enumerate(jobs):
-            job() # wait for job to finish
-            #BLA")
-            #print(job.result)
-            #print("BLU")
-            #exit()
-            expected_responses_list[idx] = job.result
-
-        cluster.close()
-        
-        # relaunch dispynodes because of this bug: https://github.com/pgiri/dispy/issues/143
-        #cmd_str = 'launch_remote_dispynodes.sh ' + self.output_dir + ' ' + ' '.join(self.compute_nodes)
-        #os.system(cmd_str)
-        #time.sleep(3)
-        #'''
-
-        '''
-        ts = time()
-        num_cores = int(available_cpu_count())
-        #num_cores = 32
-        #print(num_cores)
-        #exit()
-        os.environ["OMP_NUM_THREADS"] = "1"
-        pool = ThreadPool(num_cores)
-        #pool.map(Nearest_neighbors_portfolio.compute_expected_response, range(num_observations))
-        expected_responses_list = pool.starmap(Nearest_neighbors_portfolio.compute_expected_response,
-                                zip(itertools.repeat("compute_expected_responses_globals"), range(num_observations)))
-
-        pool.close()
-        pool.join()
-        te = time()
-        #os.environ.pop("OMP_NUM_THREADS")
-
-        expected_responses = torch.stack(expected_responses_list).numpy()
-        '''
-
-        expected_responses = expected_responses_list.numpy()
-
-        return expected_responses
-
-    @staticmethod
-    def compute_expected_response(global_arrays_class_name, j):
-
-        ## Context of interest
-        #####xbar = compute_expected_responses_globals.Xbar_tensor[j]
-        global_arrays = globals()[global_arrays_class_name]
-        xbar = global_arrays.Xbar_tensor[j]
-
-        sorted_nearest_neighbors = Nearest_neighbors_portfolio.compute_sorted_nearest_neighbors(global_arrays, xbar)
-
-        return torch.mean(sorted_nearest_neighbors, 0)
-
-    @staticmethod
-    def compute_sorted_nearest_neighbors(global_arrays, xbar):
-
-        # x1 - x2
-        #####Xsub = (compute_expected_responses_globals.X_tensor - xbar).transpose(0, 1)
-        #x_tensor = globals()[global_arrays_class_name].X_tensor
-        Xsub = (global_arrays.X_tensor - xbar).transpose(0, 1)
-
-        #####lower_diag = compute_expected_responses_globals.hyperparameters_object.upper_diag.clone().transpose(0, 1)
-        hyperparameters_obj = global_arrays.hyperparameters_object
-        lower_diag = hyperparameters_obj.upper_diag.clone().transpose(0, 1)
-        Z = torch.trtrs(Xsub, lower_diag, upper=False)[0].transpose(0, 1)
-
-        # mahalanobis_distances: mahalanobis distance of each X vector to Xbar
-        # L2 norm -- note: square root not necessary, since we only car about sorting not absolute actual number
-        # but since speed of this call is not a bottleneck, this is fine
-        mahalanobis_distances = torch.norm(Z, p=2, dim=1)
-
-        ## SORT the data based on distance to xbar
-        mahalanobis_distances_sorted, sorted_indices = torch.sort(mahalanobis_distances, 0)
-
-        #####Y_sorted = compute_expected_responses_globals.Y_tensor[sorted_indices]  # now local scope
-        Y_sorted = global_arrays.Y_tensor[sorted_indices]  # now local scope
-
-        # adjust k to avoid eliminating equi-distant points
-        #####k = compute_expected_responses_globals.hyperparameters_object.k
-        k = global_arrays.hyperparameters_object.k
-        inclusive_distance_boundary = mahalanobis_distances_sorted[k - 1] + 1e-7
-
-        # cast to int because of weird incompatibility between zero-dim tensor and int in pytorch 0.4.0
-        inclusive_k = int(np.searchsorted(mahalanobis_distances_sorted, inclusive_distance_boundary, side='right'))
-
-        # get indices of nearest neighbors
-        inclusive_k_nearest_neighbor_indices = np.arange(inclusive_k)
-
-        '''
-        # This is a template for applying non-naive smoother to weigh nearest-neighbor points
-        # The code was functionally tested and can be used as is except the for loop for which a form of 
-        # broadcasting should be found, if possible for the smoother in question (for speed)           
-        weights = mahalanobis_distances[inclusive_k_nearest_neighbor_indices] / hyperparameters_object.bandwidth
-        for i in inclusive_k_nearest_neighbor_indices:
-            weights[i] = hyperparameters_object.smoother(weights[i])
-        weights = weights / sum(weights)
-
-        # unsqueeze(1)/view(inclusive_k, 1) for broadcast multiplication to work as expected;
-        # double() needed because smoother tested (naive) spits out a float (1.0) value instead of double.
-        # double() likely won't be needed if/when this actually needs to be used
-        # since smoother will likely divide/multiply an existing double() and therefore return a double
-        weights = weights.view(inclusive_k, 1).double()
-
-        # E[Y|xbar], ie weighted/"smoothed" average of the Y[i,:] corresponding to the nearest inclusive_k X
-        expected_response[j] = torch.sum(weights * Y_tensor[inclusive_k_nearest_neighbor_indices].view(
-            inclusive_k, num_assets), 0)
-
-        '''
-
-        return Y_sorted[inclusive_k_nearest_neighbor_indices]
-
-
-#    @timed
-    @staticmethod
-    def compute_optimal_portfolio(global_arrays_class_name, j):
-        import random
-        import numpy as np
-        from math import sqrt, floor, ceil
-        import cvxpy as cp
-        import smoother
-        import hyperparameters
-        import torch
-        import os
-
-        os.environ["OMP_NUM_THREADS"] = "1"
-        #if j%100 == 0:
-        #    print("compute_optimal_portfolio: start k-nearest: ", j)
-
-        # 1. get nearest neighbors
-        global_arrays = globals()[global_arrays_class_name]
-        xbar = global_arrays.Xbar_tensor[j]
-
-        sorted_nn_tensor = Nearest_neighbors_portfolio.compute_sorted_nearest_neighbors(global_arrays, xbar)
-        nearest_neighbors = sorted_nn_tensor.numpy()
-
-        # 2. set up optimization problem
-        loss_len = len(nearest_neighbors)
-        num_assets = global_arrays.Y_tensor.size(1)
-        z = cp.Variable(num_assets)
-        L = cp.Variable(loss_len)
-        b = cp.Variable(1)
-
-        # note: just "sum" instead of long sum_entries command appears to work
-
-        #print("compute_optimal_portfolio: start A: ", j)
-        obj = cp.Minimize(cp.sum(L)/loss_len)
-
-        # Constraints
-        # long only and unit leverage
-        constrs = [z>=0, sum(z)==1]
-
-        epsilon = global_arrays.epsilon
-        __lambda = global_arrays.__lambda
-
-        for i in range(loss_len):
-            # this must define the loss function L. Second part obvious
-            # not sure why first part is the same?
-            constrs = constrs + [L[i] >= (1-1/epsilon)*b - (__lambda+1/epsilon)*sum(cp.multiply(nearest_neighbors[i], z))]
-            constrs = constrs + [L[i] >= b - __lambda*sum(cp.multiply(nearest_neighbors[i, :], z))]
-
-        # find optimal z, VaR (b) -- which minimizes total cost
-        # this minimum total cost (over hitorical points) is problem.optval
-
-        #print("compute_optimal_portfolio: start B: ", j)
-        problem=cp.Problem(obj, constrs)
-
-
-        # 3. now, optimize
-
-        # note: ECOS solver would probably be picked by cvxpy
-        # TODO: run with default, see if it picks a faster one / compare speed of different solvers
-        # note: more solvers can be added to core cvxpy
-        # see "choosing a solver": http://www.cvxpy.org/tutorial/advanced/index.html
-        # note that SCS can use GPUs -- See https://github.com/cvxgrp/cvxpy/issues/245
-        # can Boyd's POGS solver be used?
-        # look into warm start -- make sure it is leveraged
-        #print("compute_optimal_portfolio: start optimization: ", j)
-        problem.solve(solver=cp.ECOS)
-
-        os.environ.pop("OMP_NUM_THREADS")
-
-        return (problem.value, z.value, b.value, problem.status)
+        num_observations = np.size(Xbar, 0)
+
+        stage_params = {}
+        stage_params.update(self.dataset_reference('y', Y, x_indices))
+        stage_params.update(self.dataset_reference('x', X, x_indices))
+        stage_params.update(self.dataset_reference('xbar', Xbar, xbar_indices))
+        stage_params.update(self.dataset_reference('ybar', Ybar, xbar_indices))
+        stage_params_filepath = self.session.write_stage_params("compute_squared_errors_sweep_params",
+                                                                k=np.asarray(k_list), lower_diag=upper_diag.transpose(0, 1),
+                                                                sweep_smoothers=np.array([str(test_smoother) for test_smoother, _ in sweep]),
+                                                                sweep_bandwidths=np.array([bandwidth for _, bandwidth in sweep], dtype=np.float64),
+                                                                neighbor_backend=self.neighbor_backend,
+                                                                max_block_bytes=self.max_block_bytes, **stage_params)
+
+        # each job handles a chunk of contexts of interest
+        # summed over chunks as they complete
+        squared_errors = [0]
+        def consume(start, stop, squared_errors_chunk):
+            squared_errors[0] = squared_errors[0] + squared_errors_chunk
+
+        self.session.run_chunks("compute_squared_errors_sweep", stage_params_filepath, num_observations, consume)
+
+        return squared_errors[0]
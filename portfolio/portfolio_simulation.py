@@ -2,6 +2,7 @@
 import time
 import logging
 import portfolio_simulator
+import tracing
 import torch
 from available_cpu_count import available_cpu_count
 import argparse
@@ -31,10 +32,27 @@ parser.add_argument("-o", "--output_dir", type=str, help="directory in which to
 parser.add_argument("-s", "--sanity", help="make code deterministic and use 1000-sample existing dataset for debugging", action="store_true")
 parser.add_argument("-r", "--short", help="make code deterministic and use 10,000-sample existing dataset for debugging", action="store_true")
 parser.add_argument("-p", "--profile", help="turn on advanced profiling", action="store_true")
-parser.add_argument('-c','--compute_nodes', nargs='+', help='compute node names', required=True)
-parser.add_argument('-m','--compute_nodes_pythonic', nargs='+', help='python-friendly compute node names', required=True)
+parser.add_argument('-c','--compute_nodes', nargs='+', help='compute node names (dispy executor only)')
+parser.add_argument('-m','--compute_nodes_pythonic', nargs='+', help='python-friendly compute node names (dispy executor only)')
+parser.add_argument("-n", "--neighbor_backend", type=str, choices=["brute", "kd_tree"], default="brute", help="nearest neighbor search: exhaustive blocked scan or KD-tree over whitened covariates")
+parser.add_argument("-e", "--executor", type=str, choices=["serial", "pool", "dispy"], default="dispy", help="where jobs run: in-process (debugging), local process pool sharing X/Y in shared memory, or dispy cluster")
+parser.add_argument("-w", "--num_workers", type=int, help="number of processes of the pool executor (default: available cpus)")
+parser.add_argument("-l", "--lp_solver", type=str, choices=["ecos", "highs", "highs_warm"], default="ecos", help="CVaR LP solver: ECOS through the compiled cvxpy problem, HiGHS on the directly assembled sparse LP, or HiGHS (needs highspy) updating one model from query to query and restarting from the previous basis")
+parser.add_argument("--share_lp_solutions", help="pool executor: share the LP solution cache between worker processes", action="store_true")
+parser.add_argument("--learning_curve", help="sweep the training set sizes over nested training sets", action="store_true")
+parser.add_argument("-b", "--max_block_mb", type=int, default=64, help="memory budget (MB) of one block of queries of a nearest neighbor pass, on each worker")
+parser.add_argument("--smoothers", nargs='+', default=["Naive"], choices=["Naive", "Uniform", "Triangular", "Epanechnikov", "Quartic", "Triweight", "Tricubic", "Gaussian", "Cosine", "Logistic", "Sigmoid"], help="smoothers considered by the hyperparameter search")
+parser.add_argument("--num_bandwidths", type=int, default=10, help="number of log-spaced bandwidths tried for each non-naive smoother")
+parser.add_argument("--mmap", help="memory-map the dataset read-only, so all workers of a node share one page-cached copy", action="store_true")
+parser.add_argument("--autogen_cache_mb", type=int, default=2048, help="disk budget (MB) of the content-addressed stage parameters under output_dir/autogen, least recently used evicted first")
+parser.add_argument("--resume", type=str, metavar="DIR", help="output directory of an interrupted run: chunks completed there (DIR/checkpoints) are reused, only the missing work is recomputed (without it, checkpoints of an earlier run are never read, and an output directory which holds some is refused)")
+parser.add_argument("--trace", help="record nested spans (stages, chunks, LP solves of in-process jobs) to output_dir/trace.json, for chrome://tracing or Perfetto", action="store_true")
+parser.add_argument("--no_span_log", help="do not log the start and end of every timed stage", action="store_true")
 args = parser.parse_args()
 
+if args.executor == "dispy" and not (args.compute_nodes and args.compute_nodes_pythonic):
+    parser.error("the dispy executor requires --compute_nodes and --compute_nodes_pythonic")
+
 # configure logger
 logger = logging.getLogger('portfolio_simulation')
 logger.propagate = 0
@@ -45,6 +63,11 @@ formatter = logging.Formatter('%(name)s - %(levelname)s: - %(message)s')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+# span sinks: the indented stage log, and a Chrome trace
+if not args.no_span_log:
+    tracing.tracer.add_sink(tracing.Logging_sink())
+trace_sink = tracing.tracer.add_sink(tracing.Chrome_trace_sink()) if args.trace else None
+
 # launch simulation
 logger.info(time.ctime())
 logger.info("Start portfolio simulation")
@@ -54,8 +77,16 @@ num_samples_list=[8]
 
 simulator = portfolio_simulator.Portfolio_simulator("simulator", args.compute_nodes, args.compute_nodes_pythonic,
                                                     num_iterations, num_samples_list, args.output_dir, args.sanity,
-                                                    args.short, args.profile, "data/X_nt.npy", "data/Y_nt.npy", device)
-simulator.run_simulation()
+                                                    args.short, args.profile, "data/X_nt.npy", "data/Y_nt.npy", device,
+                                                    args.neighbor_backend, args.executor, args.num_workers, args.lp_solver,
+                                                    args.share_lp_solutions, args.learning_curve,
+                                                    args.max_block_mb * 1024 * 1024, args.smoothers, args.num_bandwidths,
+                                                    args.mmap, args.autogen_cache_mb * 1024 * 1024, args.resume)
+try:
+    simulator.run_simulation()
+finally:
+    if trace_sink is not None:
+        trace_sink.write(args.output_dir + '/trace.json')
 logger.info("End portfolio simulation")
 logger.info(time.ctime())
 
@@ -1,5 +1,12 @@
+import os
+import random
+import numpy as np
 import portfolio
+import compute_session
+import knn
+import executors
 import logging
+import tracing
 from decorators import timed, profile
 import torch
 import sys
@@ -7,7 +14,12 @@ import sys
 class Portfolio_simulator:
 
 
-    def __init__(self, name, compute_nodes, compute_nodes_pythonic, num_iterations, num_samples_list, output_dir, sanity=False, short=False, profile=False, x_data_filename='', y_data_filename='', device=torch.device('cpu')):
+    def __init__(self, name, compute_nodes, compute_nodes_pythonic, num_iterations, num_samples_list, output_dir,
+                 sanity=False, short=False, profile=False, x_data_filename='', y_data_filename='',
+                 device=torch.device('cpu'), neighbor_backend="brute", executor="dispy", num_workers=None,
+                 lp_solver="ecos", share_lp_solutions=False, learning_curve=False,
+                 max_block_bytes=knn.DEFAULT_BLOCK_BYTES, smoother_names=None, num_bandwidths=10, mmap=False,
+                 autogen_max_bytes=2*1024*1024*1024, resume_dir=None):
         self.name = name
         self.compute_nodes = compute_nodes
         self.compute_nodes_pythonic = compute_nodes_pythonic
@@ -20,6 +32,26 @@ class Portfolio_simulator:
         self.x_data_filename = x_data_filename
         self.y_data_filename = y_data_filename
         self.device = device
+        self.neighbor_backend = neighbor_backend
+        # where jobs run: "serial", "pool" (local processes sharing X/Y) or "dispy"
+        self.executor = executor
+        self.num_workers = num_workers
+        self.lp_solver = lp_solver
+        # pool executor only: one LP solution cache for all worker processes
+        self.share_lp_solutions = share_lp_solutions
+        # sweep num_samples_list over nested training sets (see Nearest_neighbors_portfolio.compute_learning_curve)
+        self.learning_curve = learning_curve
+        # memory budget of one block of queries of a nearest neighbor pass, on each worker
+        self.max_block_bytes = max_block_bytes
+        # smoothers and bandwidth grid size of the hyperparameter search
+        self.smoother_names = ["Naive"] if smoother_names is None else smoother_names
+        self.num_bandwidths = num_bandwidths
+        # memory-map the dataset read-only on the driver and every worker, instead of private copies
+        self.mmap = mmap
+        # disk budget of the content-addressed stage parameters under output_dir/autogen
+        self.autogen_max_bytes = autogen_max_bytes
+        # output directory of an interrupted run, whose checkpoints are reused (and extended)
+        self.resume_dir = resume_dir
         self.configure_logger()
 
     def __str__(self):
@@ -35,9 +67,10 @@ class Portfolio_simulator:
         self.ch = logging.StreamHandler()
         self.ch.setLevel(logging.INFO)
         # create formatter and add it to the handlers
-        # just a placeholder -- will be updated on the fly by timed decorator
-        formatter = logging.Formatter('    %(name)s - %(levelname)s: - %(message)s')
+        # lines are indented by the nesting of the current span (see tracing.Indent_filter)
+        formatter = logging.Formatter('%(indent)s%(name)s - %(levelname)s: - %(message)s')
         self.ch.setFormatter(formatter)
+        self.ch.addFilter(tracing.indent_filter)
         # add the handlers to the logger
         self.logger.addHandler(self.ch)
 
@@ -60,10 +93,60 @@ class Portfolio_simulator:
         else:
             raise ValueError("ERROR: gen data not integrated yet")
 
+        # per-chunk results of every stage go to the checkpoints of this run, or of the run being resumed; those of
+        # an earlier run are only ever read when resuming it, never picked up by a new run
+        if self.resume_dir:
+            checkpoint_dir = self.resume_dir + '/checkpoints'
+            if not os.path.isfile(checkpoint_dir + '/seed.txt'):
+                raise ValueError("ERROR: nothing to resume in " + self.resume_dir + " (no checkpoints/seed.txt)")
+        else:
+            checkpoint_dir = self.output_dir + '/checkpoints'
+            if os.path.isdir(checkpoint_dir) and os.listdir(checkpoint_dir):
+                raise ValueError("ERROR: " + checkpoint_dir + " holds the checkpoints of an earlier run: pass --resume " +
+                                 self.output_dir + " to continue it, or choose another output directory")
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.seed_random(checkpoint_dir)
+
+        # start workers and load the dataset on every node once for all stages of the simulation
+        me_dir = os.path.dirname(os.path.realpath(__file__))
+        executor = executors.build_executor(self.executor, self.compute_nodes_pythonic, self.num_workers,
+                                            self.share_lp_solutions, self.mmap)
+        self.session = compute_session.Compute_session("session", executor, self.output_dir,
+                                                       me_dir + '/' + x_samples_filename,
+                                                       me_dir + '/' + y_samples_filename,
+                                                       autogen_max_bytes=self.autogen_max_bytes,
+                                                       checkpoint_dir=checkpoint_dir, resume=bool(self.resume_dir))
+        self.session.start()
+        try:
+            self.run_stages(epsilon, lambda_, x_samples_filename, y_samples_filename)
+        finally:
+            self.session.close()
+
+    def seed_random(self, checkpoint_dir):
+
+        # random training/validation splits are drawn from a seed saved with the checkpoints, so a resumed run
+        # draws the same splits, hence the same stages, as the run it resumes
+        seed_filepath = checkpoint_dir + '/seed.txt'
+        if self.resume_dir:
+            with open(seed_filepath) as seed_file:
+                seed = int(seed_file.read())
+        else:
+            seed = random.SystemRandom().randrange(2**32)
+            with open(seed_filepath, 'w') as seed_file:
+                seed_file.write(str(seed))
+        random.seed(seed)
+
+    def run_stages(self, epsilon, lambda_, x_samples_filename, y_samples_filename):
+
         nn_portfolio = portfolio.Nearest_neighbors_portfolio("nn_portfolio", self.compute_nodes,
                                                              self.compute_nodes_pythonic, epsilon, lambda_,
                                                              self.output_dir, x_samples_filename, y_samples_filename,
-                                                             self.sanity, self.short, self.profile)
+                                                             self.sanity, self.short, self.profile,
+                                                             neighbor_backend=self.neighbor_backend,
+                                                             session=self.session, lp_solver=self.lp_solver,
+                                                             max_block_bytes=self.max_block_bytes,
+                                                             smoother_names=self.smoother_names,
+                                                             num_bandwidths=self.num_bandwidths, mmap=self.mmap)
 
 
         # load data
@@ -88,6 +171,20 @@ class Portfolio_simulator:
 
         print(fi_oos_cost)
 
+        if self.learning_curve:
+
+            # every size of every iteration in one pass over nested training sets
+            tr_oos_costs = nn_portfolio.compute_learning_curve(self.num_samples_list, self.num_iterations)
+
+            num_samples_list = sorted(tr_oos_costs)
+            for num_samples in num_samples_list:
+                self.logger.info("Training model oos cost with " + str(num_samples) + " samples: " +
+                                 str(np.mean(tr_oos_costs[num_samples])))
+
+            np.savez(self.output_dir + '/learning_curve.npz', fi_oos_cost=fi_oos_cost,
+                     num_samples=np.array(num_samples_list),
+                     tr_oos_costs=np.array([tr_oos_costs[num_samples] for num_samples in num_samples_list]))
+
         '''
 
         # outer loop especially useful at low number of samples
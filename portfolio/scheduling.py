@@ -0,0 +1,108 @@
+from collections import deque
+from math import ceil
+import numpy as np
+
+
+class Guided_chunker:
+
+    """
+    Hands out [start, stop) chunks of num_items queries (guided scheduling):
+
+        -- each chunk is a share of what remains, so chunks are big first and small at the tail, which
+           keeps every worker busy until the end
+        -- each chunk is also capped to last about target_seconds, given the per-query runtime observed
+           on the chunks completed so far; until a runtime is observed, chunks are at most initial_chunk_size,
+           by default initial_share of the fair share of a worker (num_items / num_workers): large enough that
+           the first jobs amortize their dispatch overhead however many workers there are, small enough that
+           runtimes come back while most of the work is still to be handed out
+
+    If ranges is given, only the queries of those [start, stop) ranges are handed out (eg those not completed by
+    an interrupted run), and no chunk straddles two ranges.
+    """
+
+    def __init__(self, num_items, num_workers, target_seconds=2.0, initial_chunk_size=None, min_chunk_size=1, ranges=None, initial_share=0.125):
+        self.num_items = num_items
+        self.num_workers = max(int(num_workers), 1)
+        self.target_seconds = target_seconds
+        self.min_chunk_size = min_chunk_size
+        self.ranges = deque([(0, num_items)] if ranges is None else [(start, stop) for start, stop in ranges if stop > start])
+        self.remaining = sum(stop - start for start, stop in self.ranges)
+        # chunk size cap until a runtime is observed
+        if initial_chunk_size is None:
+            initial_chunk_size = int(ceil(initial_share * self.remaining / self.num_workers))
+        self.initial_chunk_size = max(initial_chunk_size, min_chunk_size)
+        self.seconds_per_item = None
+
+    def next_chunk(self):
+
+        remaining = self.remaining
+        if remaining <= 0:
+            return None
+
+        # guided: a fraction of the remaining work per worker
+        chunk_size = int(ceil(remaining / (2 * self.num_workers)))
+
+        # adaptive: no longer than target_seconds at the observed runtime
+        if self.seconds_per_item is None:
+            chunk_size = min(chunk_size, self.initial_chunk_size)
+        elif self.seconds_per_item > 0:
+            chunk_size = min(chunk_size, int(self.target_seconds / self.seconds_per_item))
+
+        start, range_stop = self.ranges[0]
+        chunk_size = min(max(chunk_size, self.min_chunk_size), range_stop - start)
+
+        if start + chunk_size == range_stop:
+            self.ranges.popleft()
+        else:
+            self.ranges[0] = (start + chunk_size, range_stop)
+        self.remaining -= chunk_size
+
+        return (start, start + chunk_size)
+
+    def record(self, start, stop, seconds):
+
+        # exponentially weighted so the estimate follows drifts in runtime (eg kd-tree cells of varying density)
+        seconds_per_item = seconds / max(stop - start, 1)
+        if self.seconds_per_item is None:
+            self.seconds_per_item = seconds_per_item
+        else:
+            self.seconds_per_item = 0.8 * self.seconds_per_item + 0.2 * seconds_per_item
+
+
+def morton_order(points, bits_per_dimension=None):
+
+    """
+    Arguments:
+
+        points: coordinates, one point per row (num_points x num_dimensions)
+        bits_per_dimension: resolution of the grid each coordinate is quantized to (default: as fine as fits in
+                            63 bits)
+
+    Returns:
+
+        order: permutation of the rows which walks the points along a Morton (Z-order) curve
+
+    Description:
+
+        Interleaving the bits of the quantized coordinates gives a key whose sort order keeps points which are
+        close in space mostly close in the ordering, so contiguous chunks of the ordering hold nearby points.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+    num_points, num_dimensions = points.shape
+    if bits_per_dimension is None:
+        bits_per_dimension = 63 // max(num_dimensions, 1)
+
+    # quantize each coordinate to [0, 2^bits) over the bounding box of the points
+    low = points.min(0) if num_points else np.zeros(num_dimensions)
+    extent = np.ptp(points, 0) if num_points else np.ones(num_dimensions)
+    extent[extent == 0] = 1
+    max_cell = (1 << bits_per_dimension) - 1
+    cells = np.minimum((points - low) / extent * (max_cell + 1), max_cell).astype(np.uint64)
+
+    codes = np.zeros(num_points, dtype=np.uint64)
+    for bit in range(bits_per_dimension):
+        for dimension in range(num_dimensions):
+            codes |= ((cells[:, dimension] >> np.uint64(bit)) & np.uint64(1)) << \
+                     np.uint64(bit * num_dimensions + dimension)
+
+    return np.argsort(codes, kind='stable')
@@ -1,4 +1,17 @@
 import numpy as np
+import torch
+
+def as_distances(d):
+
+    # every smoother works elementwise on whole distance tensors (eg a block of queries x neighbors)
+    return torch.as_tensor(d, dtype=torch.float64) if not torch.is_tensor(d) else d
+
+
+def support(d):
+
+    # 1 where |d| <= 1, 0 elsewhere, for the compactly supported kernels
+    return (torch.abs(d) <= 1).type_as(d)
+
 
 class Smoother:
 
@@ -45,19 +58,24 @@ class Smoother:
     def __eq__(self, other): 
         return self.name == other
 
+    def weights(self, d, bandwidth=1):
+
+        # smoother coefficients of a whole block of distances, as seen through the bandwidth
+        return self.selected_smoother(as_distances(d) / bandwidth)
+
     def naive_smoother(self, d):
         """
             naive_smoother(d)
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-        return 1.0
+        return torch.ones_like(as_distances(d))
 
 
     def uniform_smoother(self, d):
@@ -66,18 +84,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-
-        Sn = 0.0
-        if abs(d) <= 1:
-            Sn = 0.5
-
-        return Sn
+        d = as_distances(d)
+        return 0.5 * support(d)
 
 
     def triangular_smoother(self, d):
@@ -86,18 +100,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-
-        Sn = 0
-        if abs(d) <= 1:
-            Sn = 1-d
-
-        return Sn
+        d = as_distances(d)
+        return (1-d) * support(d)
 
 
     def epanechnikov_smoother(self, d):
@@ -106,18 +116,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-
-        Sn = 0
-        if abs(d) <= 1:
-            Sn = 3/4*(1-d^2)
-
-        return Sn
+        d = as_distances(d)
+        return 3/4*(1-d**2) * support(d)
 
 
     def quartic_smoother(self, d):
@@ -126,18 +132,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-
-        Sn = 0
-        if abs(d) <= 1:
-            Sn = 15/16*(1-d**2)**2
-
-        return Sn
+        d = as_distances(d)
+        return 15/16*(1-d**2)**2 * support(d)
 
 
     def triweight_smoother(self, d):
@@ -146,18 +148,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-
-        Sn = 0
-        if abs(d) <= 1:
-            Sn = 35/32*(1-d**2)**3
-
-        return Sn
+        d = as_distances(d)
+        return 35/32*(1-d**2)**3 * support(d)
 
 
     def tricubic_smoother(self, d):
@@ -166,13 +164,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-        return max(70/81*(1-d**3), 0)
+        d = as_distances(d)
+        return torch.clamp(70/81*(1-d**3), min=0)
 
 
     def gaussian_smoother(self, d):
@@ -181,14 +180,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-        return np.exp(-d**2)/np.sqrt(2*np.pi)
-
+        d = as_distances(d)
+        return torch.exp(-d**2)/np.sqrt(2*np.pi)
 
 
     def cosine_smoother(self, d):
@@ -197,18 +196,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-
-        Sn = 0
-        if abs(d) <= 1:
-            Sn = np.pi/4 * cos(np.pi/2 * d)
-
-        return Sn
+        d = as_distances(d)
+        return np.pi/4 * torch.cos(np.pi/2 * d) * support(d)
 
 
     def logistic_smoother(self, d):
@@ -217,14 +212,14 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-        return 1 / (np.exp(d) + 2 + np.exp(-d))
-
+        d = as_distances(d)
+        return 1 / (torch.exp(d) + 2 + torch.exp(-d))
 
 
     def sigmoid_smoother(self, d):
@@ -233,10 +228,11 @@ class Smoother:
 
         # Arguments
 
-            1. d : Distance between two points
+            1. d : Distance(s) between two points -- scalar, array or tensor
 
         # Returns
 
-            1. Sn : Smoother coefficient
+            1. Sn : Smoother coefficient(s), as a tensor of the shape of d
         """
-        return 2/np.pi * 1/(exp(d)+exp(-d))
+        d = as_distances(d)
+        return 2/np.pi * 1/(torch.exp(d)+torch.exp(-d))
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import socket
+from collections import defaultdict
+import numpy as np
+
+
+class Job_telemetry:
+
+    """
+    Phase timings and counters of the job running on this worker process, reset by executors.run_stage before
+    each job and shipped back with its result:
+
+        -- phase(name) adds the wall time of a block of code to the phase (eg neighbor search, LP build, solver);
+           phases may nest, each one only gets the time not spent in the phases nested in it, so phases add up to
+           at most the job time
+        -- count(name, n) adds to a counter (eg queries, neighbors, solver iterations)
+    """
+
+    def __init__(self):
+        self.hostname = socket.gethostname()
+        self.reset()
+
+    def reset(self):
+        self.phases = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.stack = []
+        self.start = time.time()
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_phase(self, name, seconds):
+
+        # time measured by other means (eg reported by the solver), inside the current phase if any
+        self.phases[name] += seconds
+        if self.stack:
+            self.stack[-1].nested_seconds += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def summary(self):
+
+        # compact and picklable: plain dicts of floats and ints
+        return {'hostname': self.hostname, 'pid': os.getpid(), 'start': self.start, 'end': time.time(),
+                'phases': dict(self.phases), 'counters': dict(self.counters)}
+
+
+class Phase:
+
+    __slots__ = ('job', 'name', 'start', 'nested_seconds')
+
+    def __init__(self, job, name):
+        self.job = job
+        self.name = name
+        self.nested_seconds = 0.0
+
+    def __enter__(self):
+        self.job.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.job.stack.pop()
+        # own time only; the enclosing phase (if any) counts all of this one as nested
+        self.job.add_phase(self.name, seconds - self.nested_seconds)
+        if self.job.stack:
+            self.job.stack[-1].nested_seconds += self.nested_seconds
+        return False
+
+
+# telemetry of the current job of this worker process
+job = Job_telemetry()
+
+
+def percentiles(values):
+    values = np.asarray(values)
+    return {'p50': float(np.percentile(values, 50)), 'p99': float(np.percentile(values, 99)),
+            'max': float(np.max(values))} if len(values) else {}
+
+
+class Telemetry_report:
+
+    """
+    Driver-side summary of the telemetry of every job of a session, per node and per phase:
+
+        -- per node: jobs, queries, throughput (queries per busy second, and per second of the node's span of
+           activity), job latency tails, busy and idle time of its worker processes (idle: time between the first
+           job start and the last job end of a worker not spent on a job), dispatch overhead (round trip seen by
+           the driver minus time spent on the worker: queueing, pickling, transfer)
+        -- per phase: total time, share of the busy time, tails of the per-job phase time
+    """
+
+    def __init__(self):
+        self.nodes = defaultdict(lambda: {'jobs': 0, 'queries': 0, 'busy_seconds': 0.0, 'job_seconds': [],
+                                          'dispatch_seconds': [], 'counters': defaultdict(int)})
+        # (hostname, pid) -> [first job start, last job end, busy seconds]
+        self.workers = {}
+        self.phases = defaultdict(list)
+        self.functions = defaultdict(int)
+
+    def record(self, function_name, start, stop, job_telemetry, round_trip_seconds):
+
+        seconds = job_telemetry['end'] - job_telemetry['start']
+        node = self.nodes[job_telemetry['hostname']]
+        node['jobs'] += 1
+        node['queries'] += stop - start
+        node['busy_seconds'] += seconds
+        node['job_seconds'].append(seconds)
+        node['dispatch_seconds'].append(max(round_trip_seconds - seconds, 0.0))
+        for name, value in job_telemetry['counters'].items():
+            node['counters'][name] += value
+
+        worker = (job_telemetry['hostname'], job_telemetry['pid'])
+        first_start, last_end, busy_seconds = self.workers.get(worker, (job_telemetry['start'], job_telemetry['end'], 0.0))
+        self.workers[worker] = (min(first_start, job_telemetry['start']), max(last_end, job_telemetry['end']),
+                                busy_seconds + seconds)
+
+        for name, phase_seconds in job_telemetry['phases'].items():
+            self.phases[name].append(phase_seconds)
+        self.functions[function_name] += 1
+
+    def summary(self):
+
+        nodes = {}
+        for hostname, node in self.nodes.items():
+            workers = [span for worker, span in self.workers.items() if worker[0] == hostname]
+            active_seconds = max(end for _, end, _ in workers) - min(start for start, _, _ in workers)
+            nodes[hostname] = {
+                'jobs': node['jobs'],
+                'queries': node['queries'],
+                'workers': len(workers),
+                'busy_seconds': node['busy_seconds'],
+                'idle_seconds': sum(end - start - busy for start, end, busy in workers),
+                'queries_per_busy_second': node['queries'] / node['busy_seconds'] if node['busy_seconds'] else None,
+                'queries_per_second': node['queries'] / active_seconds if active_seconds else None,
+                'job_seconds': percentiles(node['job_seconds']),
+                'dispatch_seconds': percentiles(node['dispatch_seconds']),
+                'counters': dict(node['counters']),
+            }
+
+        busy_seconds = sum(node['busy_seconds'] for node in self.nodes.values())
+        phases = {name: dict(total_seconds=float(np.sum(values)),
+                             share_of_busy=float(np.sum(values)) / busy_seconds if busy_seconds else None,
+                             per_job_seconds=percentiles(values))
+                  for name, values in self.phases.items()}
+
+        return {'jobs_by_function': dict(self.functions), 'nodes': nodes, 'phases': phases}
+
+    def write(self, filepath):
+        with open(filepath, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import pytest
+import portfolio
+import executors
+import compute_session
+import learning_curve
+
+
+@pytest.fixture
+def nn_portfolio(tmp_path):
+
+    # small synthetic dataset (3 covariates, 12 assets), evaluated on the serial executor
+    rng = np.random.RandomState(1)
+    x_filepath = str(tmp_path / 'X.npy')
+    y_filepath = str(tmp_path / 'Y.npy')
+    np.save(x_filepath, rng.normal(size=(120, 3)))
+    np.save(y_filepath, 0.05 * rng.normal(size=(120, 12)))
+    os.mkdir(str(tmp_path / 'autogen'))
+
+    session = compute_session.Compute_session("session", executors.build_executor("serial"), str(tmp_path),
+                                              x_filepath, y_filepath)
+    session.start()
+    nn_portfolio = portfolio.Nearest_neighbors_portfolio("nn", None, None, 0.15, 0.0, str(tmp_path), x_filepath,
+                                                         y_filepath, short=True, session=session)
+    nn_portfolio.load_data()
+    nn_portfolio.compute_full_information_hyperparameters()
+
+    yield nn_portfolio
+
+    session.close()
+
+
+def training_model_oos_cost(nn_portfolio, num_samples, max_num_samples):
+
+    # cost of a single size, through the one-portfolio-per-context path
+    nested_training_sets = learning_curve.Nested_training_sets(len(nn_portfolio.X_data), deterministic=True)
+    nn_portfolio.set_num_samples(num_samples)
+    nn_portfolio.set_nested_split(nested_training_sets, max_num_samples)
+    running_covariance = learning_curve.Running_covariance(nn_portfolio.X_data.shape[1])
+    running_covariance.extend(nn_portfolio.X_tr)
+    nn_portfolio.hyperparameters_tr = nn_portfolio.compute_hyperparameters(
+        nn_portfolio.Y_tr, nn_portfolio.X_tr, indices=nn_portfolio.tr_indices,
+        covariance=running_covariance.covariance(), split=nested_training_sets.inner_split(num_samples))
+
+    return nn_portfolio.compute_training_model_oos_cost()
+
+
+def test_learning_curve_single_size(nn_portfolio):
+
+    # a single size still stacks the portfolios along a (length 1) size axis
+    tr_oos_costs = nn_portfolio.compute_learning_curve([8], 1)
+
+    assert list(tr_oos_costs) == [8]
+    assert len(tr_oos_costs[8]) == 1
+    assert tr_oos_costs[8][0] == pytest.approx(training_model_oos_cost(nn_portfolio, 8, 8))
+
+
+def test_learning_curve_sizes_share_validation_set(nn_portfolio):
+
+    tr_oos_costs = nn_portfolio.compute_learning_curve([8, 16], 1)
+
+    for num_samples in [8, 16]:
+        assert tr_oos_costs[num_samples][0] == pytest.approx(training_model_oos_cost(nn_portfolio, num_samples, 16))
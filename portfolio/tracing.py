@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+
+
+class Span:
+
+    """
+    One timed region: name, ids (parent_id is the enclosing span of the thread, or given explicitly), start and end
+    (perf_counter_ns), args (shown in the trace viewer) and the logger the log sink writes to, if any
+    """
+
+    __slots__ = ('tracer', 'name', 'span_id', 'parent_id', 'start', 'end', 'args', 'logger', 'pid', 'thread_id')
+
+    def __init__(self, tracer, name, parent_id, logger, args):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = next(tracer.span_ids)
+        self.parent_id = parent_id
+        self.logger = logger
+        self.args = args
+        self.start = None
+        self.end = None
+        self.pid = os.getpid()
+        self.thread_id = threading.get_ident()
+
+    def __enter__(self):
+
+        stack = self.tracer.stack()
+        if self.parent_id is None and stack:
+            self.parent_id = stack[-1].span_id
+        for sink in self.tracer.sinks:
+            sink.start(self)
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.end = time.perf_counter_ns()
+        self.tracer.stack().pop()
+        for sink in self.tracer.sinks:
+            sink.finish(self)
+
+        return False
+
+    def seconds(self):
+        return (self.end - self.start) / 1e9
+
+
+class Null_span:
+
+    # what span returns while no sink is attached: entering and leaving it does nothing
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = Null_span()
+
+
+class Tracer:
+
+    """
+    Nested spans, handed to every sink as they start and finish. With no sink attached (eg on pool workers),
+    span() returns a shared do-nothing span: a span then costs one attribute lookup and a truth test.
+    """
+
+    def __init__(self):
+        self.sinks = []
+        self.span_ids = itertools.count(1)
+        self.local = threading.local()
+
+    def stack(self):
+
+        # spans entered and not left yet, by the current thread
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        return stack
+
+    def depth(self):
+        return len(self.stack()) if self.sinks else 0
+
+    def span(self, name, parent_id=None, logger=None, **args):
+
+        if not self.sinks:
+            return NULL_SPAN
+
+        return Span(self, name, parent_id, logger, args)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+
+# one tracer per process
+tracer = Tracer()
+
+
+class Logging_sink:
+
+    """
+    The log lines of the timed decorator: started/finished banners of every span which has a logger (spans without
+    one, eg per query, are skipped), indented by nesting (see Indent_filter)
+    """
+
+    def start(self, span):
+        if span.logger is not None:
+            span.logger.info('**************************************************')
+            span.logger.info('Started ' + span.name)
+
+    def finish(self, span):
+        if span.logger is not None:
+            span.logger.info('Finished ' + span.name + ': took %2.4f seconds.' % span.seconds())
+            span.logger.info('**************************************************')
+
+
+class Chrome_trace_sink:
+
+    """
+    Finished spans as complete ("X") events of the Chrome trace event format, which chrome://tracing and Perfetto
+    (ui.perfetto.dev) open; span and parent ids are kept in the args of each event
+    """
+
+    def __init__(self):
+        self.events = []
+        self.origin = time.perf_counter_ns()
+
+    def start(self, span):
+        pass
+
+    def finish(self, span):
+        args = dict(span.args)
+        args.update(span_id=span.span_id, parent_id=span.parent_id)
+        self.events.append({'name': span.name, 'ph': 'X', 'ts': (span.start - self.origin) / 1000,
+                            'dur': (span.end - span.start) / 1000, 'pid': span.pid, 'tid': span.thread_id,
+                            'args': args})
+
+    def write(self, filepath):
+        with open(filepath, 'w') as trace_file:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, trace_file, default=str)
+
+
+class Indent_filter(logging.Filter):
+
+    # sets record.indent (used by the formatters of the class loggers) from the nesting of the current span
+    def filter(self, record):
+        record.indent = '    ' * (tracer.depth() + 1)
+        return True
+
+
+indent_filter = Indent_filter()
@@ -1,30 +1,45 @@
 import numpy as np
+from functools import lru_cache
 from scipy.stats import norm
 
-def value_at_risk(X, z, epsilon):
+# returns of asset i given covariates x: mean A[i]·x, standard deviation sqrt((sum(A[i])/4)^2 + (B[i]·x)^2)
+A = 0.025 * np.array([[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8]])
+B = 0.075 * np.array([[0,-1,-1],[-1,0,-1],[-1,-1,0],[0,-1,1],[-1,0,1],[-1,1,0],[0,1,-1],[1,0,-1],[1,-1,0],[0,1,1],[1,0,1],[1,1,0]])
+A_ROW_SUMS = A.sum(1) / 4
+
+
+@lru_cache(maxsize=None)
+def normal_quantile(epsilon):
+    return norm.ppf(epsilon)
+
+
+def value_at_risk_batch(X, z, epsilon):
 
-    A = 0.025 * np.array([[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8],[0.8,0.1,0.1],[0.1,0.8,0.1],[0.1,0.1,0.8]])
-    B = 0.075 * np.array([[0,-1,-1],[-1,0,-1],[-1,-1,0],[0,-1,1],[-1,0,1],[-1,1,0],[0,1,-1],[1,0,-1],[1,-1,0],[0,1,1],[1,0,1],[1,1,0]])
+    """
+    Arguments:
 
-    # since calling from Julia, X not a numpy array, need to transform it
-    X_np = np.asarray(X)
-    # do same for z even if not required, for code stability
-    z_np = np.asarray(z)
+        X: contexts, one per row (m x 3)
+        z: portfolios, one per row (m x 12, or any shape which broadcasts against it, eg a single portfolio)
+        epsilon: VaR level
 
-    m=np.empty_like(z)
-    a=np.empty_like(z)
-    b=np.empty_like(z)
-    for i in range(np.size(z)):
-        m[i]=np.matmul(A[i],X_np[:,None])*z_np[i]
-        a[i]=sum(A[i])*z[i]/4
-        b[i]=np.matmul(B[i],X_np[:,None])*z_np[i]
+    Returns:
 
-    mean_profit=sum(m)
-    var_profit=sum(np.square(a)) + sum(np.square(b))
-    std_profit=np.sqrt(var_profit)
+        value_at_risk: loss VaR of portfolio z[i] in context X[i], for each i (m)
+    """
+    X_np = np.asarray(X, dtype=np.float64).reshape(-1, A.shape[1])
+    z_np = np.asarray(z, dtype=np.float64)
 
-    value_at_risk_profit = mean_profit + std_profit * norm.ppf(epsilon)
+    mean_profit = np.sum(z_np * (X_np @ A.T), -1)
+    var_profit = np.sum(np.square(z_np * A_ROW_SUMS), -1) + np.sum(np.square(z_np * (X_np @ B.T)), -1)
+    std_profit = np.sqrt(var_profit)
+
+    value_at_risk_profit = mean_profit + std_profit * normal_quantile(float(epsilon))
 
     # loss VaR is negative of profit VaR
     return -value_at_risk_profit
 
+
+def value_at_risk(X, z, epsilon):
+
+    # single context and portfolio; since calling from Julia, X and z may not be numpy arrays
+    return value_at_risk_batch(np.asarray(X).reshape(1, -1), np.asarray(z).reshape(1, -1), epsilon)[0]